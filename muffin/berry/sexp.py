@@ -14,7 +14,7 @@
 import string
 
 from muffin.cups import All, Sep
-from muffin.pan import Alt, Cat, Ex, Red, Rep, Set, rec, tie
+from muffin.pan import Alt, Cat, Ex, Many, Red, Set, items, rec, tie
 
 
 def OneOrMore(l):
@@ -22,8 +22,7 @@ def OneOrMore(l):
     Match one or more of the given language.
     """
 
-    return Red(Cat(l, Rep(l)),
-               lambda (car, cdr): (car,) + cdr if cdr else (car,))
+    return Red(Cat(l, Many(l)), items)
 
 
 po = Ex("(")
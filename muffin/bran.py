@@ -11,14 +11,252 @@
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and limitations
 # under the License.
-from muffin.cups import Any, Bracket
-from muffin.pan import Cat, Ex, Rep, Set
+"""
+Regular expressions, parsed by Muffin and compiled into Muffin languages.
 
+The parse tree of every regular expression grammar is a language which
+matches what the expression matches, and yields the matched text. Patterns
+always match entire inputs, so there are no anchors, and since there is only
+ever one match, no captures either; groups only group.
+"""
 
-char = Set("abcdefhijklmnopqrstuvwxyz")
+import string
 
-charset = Bracket(Ex("["), Ex("]"))(char)
+from muffin.charclass import CharClass
+from muffin.cups import All, Any, Bracket, Optional, Sep
+from muffin.pan import (context, parses, patch, rec, Alt, Cat, Ex, Literal,
+                        Null, Red, Rep, Set)
 
-inverted = Bracket(Cat(Ex("["), Ex("^")), Ex("]"))(char)
 
-expr = Rep(Any([char, charset, inverted]))
+DIGIT = CharClass.between("0", "9")
+WORD = CharClass.of(string.ascii_letters + string.digits + "_")
+SPACE = CharClass.of(" \t\n\r\f\v")
+
+
+def negated(cls):
+    """
+    Every character not in a class, including all of Unicode.
+    """
+
+    return ~CharClass(cls.ranges, True)
+
+
+classes = {
+    "d": DIGIT, "D": negated(DIGIT),
+    "w": WORD, "W": negated(WORD),
+    "s": SPACE, "S": negated(SPACE),
+}
+
+controls = {"n": "\n", "t": "\t", "r": "\r", "f": "\f", "v": "\v"}
+
+
+def always(x):
+    return lambda _: x
+
+
+def second((x, y)):
+    return y
+
+
+# Escapes. Letters and digits can only be escaped if they mean something.
+
+backslash = Ex("\\")
+
+escaped = Red(Cat(backslash, Set(negated(CharClass.of(string.ascii_letters +
+                                                       string.digits)))),
+              second)
+
+control = Red(Cat(backslash, Set("".join(controls))),
+              lambda (x, y): controls[y])
+
+class_escape = Red(Cat(backslash, Set("".join(classes))),
+                   lambda (x, y): classes[y])
+
+
+# Character classes, as CharClasses. A caret at the very start negates the
+# class, and a dash can only stand for itself at either end.
+
+dash = Red(Ex("-"), CharClass.of)
+
+class_char = Any([Set(negated(CharClass.of("]\\-"))), escaped, control])
+
+first_char = Any([Set(negated(CharClass.of("]\\-^"))), escaped, control])
+
+
+def Item(char):
+    """
+    A single member of a class, starting with the given kind of character.
+    """
+
+    return Any([
+        Red(char, CharClass.of),
+        Red(Cat(char, Cat(dash, class_char)),
+            lambda (x, (y, z)): CharClass.between(x, z)),
+        class_escape,
+    ])
+
+
+def union((first, (items, last))):
+    cls = first
+    for item in (items or ()) + (last,):
+        if item is not None:
+            cls |= item
+    return cls
+
+
+rest = Cat(Rep(Item(class_char)), Optional(dash))
+
+class_body = Red(Alt(Cat(dash, rest), Cat(Item(first_char), rest)), union)
+
+charset = Red(Bracket(Ex("["), Ex("]"))(class_body), Set)
+
+inverted = Red(Bracket(Cat(Ex("["), Ex("^")), Ex("]"))(class_body),
+               lambda cls: Set(negated(cls)))
+
+
+# Atoms, as languages.
+
+char = Red(Set(negated(CharClass.of("\\.[({)|*+?^$"))), Ex)
+
+dot = Red(Ex("."), always(Set(negated(CharClass.of("\n")))))
+
+escape = Any([Red(escaped, Ex), Red(control, Ex), Red(class_escape, Set)])
+
+inner = rec("alternation")
+
+group = Bracket(Ex("("), Ex(")"))(Alt(inner, Red(Cat(Literal("?:", 0), inner),
+                                                 second)))
+
+atom = Any([char, dot, escape, charset, inverted, group])
+
+
+# Quantifiers, as functions from languages to languages.
+
+def repeat(low, high):
+    """
+    Make a function which repeats a language at least low times, and at most
+    high times, or without limit if high is None.
+
+    Raises ValueError if high is below low, as re does.
+    """
+
+    if high is not None and high < low:
+        raise ValueError("Repeat maximum %d is below its minimum %d" %
+                         (high, low))
+
+    def repeated(l):
+        ls = [l] * low
+        if high is None:
+            ls.append(Rep(l))
+        else:
+            tail = Null
+            for i in range(high - low):
+                tail = Optional(All([l, tail]) if tail is not Null else l)
+            if tail is not Null:
+                ls.append(tail)
+        if not ls:
+            return Null
+        return All(ls)
+    return repeated
+
+
+number = Red(Cat(Set(string.digits), Rep(Set(string.digits))),
+             lambda (x, xs): int(x + "".join(xs or ())))
+
+comma = Ex(",")
+
+bounds = Any([
+    Red(number, lambda n: repeat(n, n)),
+    Red(Cat(number, comma), lambda (n, c): repeat(n, None)),
+    Red(Cat(number, Cat(comma, number)), lambda (m, (c, n)): repeat(m, n)),
+])
+
+greedy = Any([
+    Red(Ex("*"), always(repeat(0, None))),
+    Red(Ex("+"), always(repeat(1, None))),
+    Red(Ex("?"), always(repeat(0, 1))),
+    Bracket(Ex("{"), Ex("}"))(bounds),
+])
+
+# Lazy quantifiers match the same inputs as greedy ones.
+quantifier = Red(Cat(greedy, Optional(Ex("?"))), lambda (f, lazy): f)
+
+quantified = Red(Cat(atom, Optional(quantifier)),
+                 lambda (l, f): f(l) if f else l)
+
+
+def sequence(ls):
+    """
+    Concatenate languages, joining runs of single characters into literals.
+    """
+
+    joined = []
+    run = []
+    for l in ls + (None,):
+        if isinstance(l, Ex):
+            run.append(l.c)
+            continue
+        if len(run) > 1:
+            joined.append(Literal("".join(run), 0))
+        elif run:
+            joined.append(Ex(run[0]))
+        run = []
+        if l is not None:
+            joined.append(l)
+
+    if not joined:
+        return Null
+    return All(joined)
+
+
+alternation = Sep(Red(Rep(quantified), lambda ls: sequence(ls or ())),
+                  Ex("|"))
+alternation = Red(alternation, lambda ls: Any(list(ls)))
+
+patch(inner, {"alternation": alternation})
+
+expr = alternation
+
+
+def text(tree):
+    """
+    Join the characters in a parse tree back into a string.
+    """
+
+    parts = []
+    stack = [tree]
+    while stack:
+        t = stack.pop()
+        if isinstance(t, tuple):
+            stack.extend(reversed(t))
+        elif t is not None:
+            parts.append(t)
+    return "".join(parts)
+
+
+def compile(pattern):
+    """
+    Compile a regular expression into a language, which yields the text it
+    matched.
+
+    Compiled patterns are cached in the current context, so that patterns
+    which are used over and over are only compiled once.
+
+    Raises ParseError if the pattern can't be parsed, and ValueError if it
+    has a repeat whose maximum is below its minimum.
+    """
+
+    patterns = context().patterns
+    l = patterns.get(pattern)
+    if l is None:
+        l, = parses(expr, pattern)
+        l = patterns[pattern] = Red(l, text)
+    return l
+
+
+def purge():
+    """
+    Forget every compiled pattern.
+    """
+
+    context().patterns.clear()
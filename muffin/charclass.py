@@ -0,0 +1,155 @@
+# Copyright (C) 2014 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+from bisect import bisect_right
+import sys
+
+
+# Code points below this are looked up in a bitmap.
+SMALL = 256
+
+
+def normalize(ranges):
+    """
+    Sort ranges of code points, merging those which overlap or touch.
+    """
+
+    merged = []
+    for lo, hi in sorted(ranges):
+        if lo > hi:
+            continue
+        if merged and lo <= merged[-1][1] + 1:
+            if hi > merged[-1][1]:
+                merged[-1] = merged[-1][0], hi
+        else:
+            merged.append((lo, hi))
+    return tuple(merged)
+
+
+class CharClass(object):
+    """
+    A set of characters, kept as sorted, disjoint ranges of code points.
+
+    Membership is a bitmap lookup for small code points, and a binary search
+    over the ranges for the rest.
+
+    Classes made from byte strings hold bytes, and are negated within the
+    bytes; classes with any unicode in them hold unicode characters.
+    """
+
+    def __init__(self, ranges, text=False):
+        self.ranges = normalize(ranges)
+        self.text = text or any(hi >= SMALL for lo, hi in self.ranges)
+        self.starts = [lo for lo, hi in self.ranges]
+
+        bitmap = 0
+        for lo, hi in self.ranges:
+            if lo >= SMALL:
+                break
+            hi = min(hi, SMALL - 1)
+            bitmap |= ((1 << (hi - lo + 1)) - 1) << lo
+        self.bitmap = bitmap
+
+    @classmethod
+    def of(cls, chars):
+        """
+        The class of the characters in a string.
+        """
+
+        return cls([(ord(c), ord(c)) for c in chars],
+                   isinstance(chars, unicode))
+
+    @classmethod
+    def between(cls, first, last):
+        """
+        The class of the characters from first to last, inclusive.
+        """
+
+        return cls([(ord(first), ord(last))],
+                   isinstance(first, unicode) or isinstance(last, unicode))
+
+    @property
+    def top(self):
+        return sys.maxunicode if self.text else SMALL - 1
+
+    def __contains__(self, c):
+        try:
+            i = ord(c)
+        except TypeError:
+            return False
+        if i < SMALL:
+            return bool(self.bitmap >> i & 1)
+        k = bisect_right(self.starts, i) - 1
+        return k >= 0 and i <= self.ranges[k][1]
+
+    def __len__(self):
+        return sum(hi - lo + 1 for lo, hi in self.ranges)
+
+    def __iter__(self):
+        char = unichr if self.text else chr
+        for lo, hi in self.ranges:
+            for i in xrange(lo, hi + 1):
+                yield char(i)
+
+    def __invert__(self):
+        ranges = []
+        lo = 0
+        for start, end in self.ranges:
+            ranges.append((lo, start - 1))
+            lo = end + 1
+        ranges.append((lo, self.top))
+        return CharClass(ranges, self.text)
+
+    def __or__(self, other):
+        return CharClass(self.ranges + other.ranges, self.text or other.text)
+
+    def __and__(self, other):
+        ranges = []
+        i = j = 0
+        while i < len(self.ranges) and j < len(other.ranges):
+            (a, b), (c, d) = self.ranges[i], other.ranges[j]
+            ranges.append((max(a, c), min(b, d)))
+            if b < d:
+                i += 1
+            else:
+                j += 1
+        return CharClass(ranges, self.text and other.text)
+
+    def __sub__(self, other):
+        return self & ~CharClass(other.ranges, self.text)
+
+    def __eq__(self, other):
+        if not isinstance(other, CharClass):
+            return NotImplemented
+        return self.ranges == other.ranges and self.text == other.text
+
+    def __ne__(self, other):
+        if not isinstance(other, CharClass):
+            return NotImplemented
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.ranges, self.text))
+
+    def __repr__(self):
+        char = unichr if self.text else chr
+        parts = []
+        for lo, hi in self.ranges:
+            if lo == hi:
+                parts.append("%r" % char(lo))
+            else:
+                parts.append("%r-%r" % (char(lo), char(hi)))
+        return "CharClass(%s)" % ", ".join(parts)
+
+    def __pretty__(self, p, cycle):
+        p.text(repr(self))
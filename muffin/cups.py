@@ -11,7 +11,8 @@
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and limitations
 # under the License.
-from muffin.pan import Alt, Cat, Empty, Ex, Red, Rep, Null
+from muffin.pan import (Alt, Alts, Cat, Cats, Empty, Literal, Many, Red, Null,
+                        items, keywords)
 
 
 fs = frozenset
@@ -54,8 +55,7 @@ def Sep(l, s):
     To get a zero-or-more version, use Optional() around this combinator.
     """
 
-    return Red(Cat(l, Rep(Red(Cat(s, l), lambda (x, y): y))),
-               lambda (car, cdr): (car,) + cdr if cdr else (car,))
+    return Red(Cat(l, Many(Red(Cat(s, l), lambda (x, y): y))), items)
 
 
 def Any(ls):
@@ -63,12 +63,19 @@ def Any(ls):
     Match any of the given languages.
     """
 
+    # Literals are looked up together, in a trie, instead of one by one.
+    literals = [l.s for l in ls if isinstance(l, Literal) and not l.i]
+    if len(literals) > 1:
+        ls = [l for l in ls if not isinstance(l, Literal) or l.i]
+        ls.append(keywords(literals))
+
     if not ls:
         return Empty
-    parser = ls[0]
-    for l in ls[1:]:
-        parser = Alt(parser, l)
-    return parser
+    if len(ls) == 1:
+        return ls[0]
+    if len(ls) == 2:
+        return Alt(ls[0], ls[1])
+    return Alts(tuple(ls))
 
 
 def All(ls):
@@ -78,10 +85,11 @@ def All(ls):
 
     if not ls:
         return Empty
-    parser = ls[0]
-    for l in ls[1:]:
-        parser = Cat(parser, l)
-    return parser
+    if len(ls) == 1:
+        return ls[0]
+    if len(ls) == 2:
+        return Cat(ls[0], ls[1])
+    return Cats(tuple(ls))
 
 
 def String(s):
@@ -89,4 +97,4 @@ def String(s):
     Match every member of the string in turn, returning the entire string.
     """
 
-    return Red(All(map(Ex, s)), lambda _: s)
+    return Literal(s, 0)
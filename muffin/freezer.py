@@ -0,0 +1,329 @@
+# Copyright (C) 2014 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+Freezing parse state, so that a parse can be suspended in one process and
+resumed in another.
+
+A derivative is the entire state of a parse, but it is full of things which
+can't be pickled: lazy thunks, composed reductions and the lambdas which
+grammars are written with. Rather than pickling them, a registry gives names
+to the grammar and to everything in it. A frozen derivative refers to the
+grammar by those names, and only spells out what parsing made. Sharing and
+cycles in the graph are kept.
+
+Names are handed out in the order a grammar is walked, so the process which
+thaws a derivative has to build its grammar the same way as the process
+which froze it, and register it under the same name.
+
+Frozen state is made of nothing but tuples, lists, strings and numbers, so
+it can be written out with marshal or pickle.
+"""
+
+import sys
+import types
+
+from muffin.pan import (missing, Any, Deferred, Empty, Lazy, Named, Node,
+                        Null, Patch, Trie)
+from muffin.utensils import Composition, curry_first, curry_second
+
+
+VERSION = 1
+
+ATOMS = (type(None), bool, int, long, float, complex, str, unicode)
+
+FIRST = curry_first(None).func_code
+SECOND = curry_second(None).func_code
+
+
+class Unregistered(Exception):
+    """
+    Raised when something can't be frozen or thawed, because it has no name
+    in the registry and can't be taken apart, like a lambda which isn't part
+    of any registered grammar.
+    """
+
+
+def global_name(obj):
+    """
+    The name of a function or class which can be imported, or None.
+    """
+
+    module = getattr(obj, "__module__", None)
+    name = getattr(obj, "__name__", None)
+    if module is None or name is None:
+        return None
+    if getattr(sys.modules.get(module), name, None) is not obj:
+        return None
+    return "%s:%s" % (module, name)
+
+
+class Registry(object):
+    """
+    Names for things which are the same in every process, and can be
+    referred to rather than frozen.
+
+    Functions and classes which can be imported are named already, as are
+    Muffin's own singletons. Something can have more than one name, if it is
+    part of more than one grammar; it is frozen under all of them, and
+    thawed under whichever is known.
+    """
+
+    def __init__(self):
+        self.names = {}
+        self.objects = {}
+        for obj in Empty, Null, Any, Patch, missing:
+            self.add("muffin.pan:%s" % obj.name, obj)
+
+    def add(self, name, obj):
+        """
+        Give something a name.
+        """
+
+        self.names[id(obj)] = self.names.get(id(obj), ()) + (name,)
+        self.objects[name] = obj
+
+    def grammar(self, name, l):
+        """
+        Name a grammar, and every language, reduction and trie in it.
+
+        Names are numbered within the grammar, so they don't depend on which
+        other grammars were registered first. Whatever grammars share is
+        named in each of them.
+        """
+
+        count = 0
+        seen = set()
+        stack = [l]
+        while stack:
+            obj = stack.pop()
+            if isinstance(obj, ATOMS):
+                continue
+            if isinstance(obj, (tuple, frozenset)):
+                stack.extend(obj)
+                continue
+            if id(obj) in seen:
+                continue
+            seen.add(id(obj))
+            self.add("%s/%d" % (name, count), obj)
+            count += 1
+
+            children = []
+            if isinstance(obj, Lazy):
+                if obj.value is not None:
+                    children.append(obj.value)
+            elif isinstance(obj, Node):
+                children.extend(obj)
+            elif isinstance(obj, Composition):
+                children.extend([obj.first, obj.then])
+            elif isinstance(obj, Trie):
+                children.extend(obj.branches[c] for c in sorted(obj.branches))
+            stack.extend(reversed(children))
+
+    def name(self, obj):
+        """
+        Every name of something, or None.
+        """
+
+        names = self.names.get(id(obj))
+        if names is None and isinstance(obj, (type, types.FunctionType)):
+            name = global_name(obj)
+            if name is not None:
+                names = name,
+        return names
+
+    def get(self, names):
+        """
+        Whatever has the first of some names which is known.
+        """
+
+        for name in names:
+            if name in self.objects:
+                return self.objects[name]
+            module, sep, attr = name.partition(":")
+            if sep:
+                __import__(module)
+                obj = getattr(sys.modules[module], attr, None)
+                if obj is not None:
+                    return obj
+        raise Unregistered(" or ".join(names))
+
+
+def parts(obj, registry):
+    """
+    Take something apart into the kind of record it is frozen as, the data
+    kept in the record, and the things it refers to.
+    """
+
+    if isinstance(obj, ATOMS):
+        return "atom", obj, ()
+    name = registry.name(obj)
+    if name is not None:
+        return "name", name, ()
+    if type(obj) in (tuple, list, frozenset, set):
+        return type(obj).__name__, None, list(obj)
+    if type(obj) is dict:
+        return "dict", None, [x for item in obj.iteritems() for x in item]
+    if isinstance(obj, Node):
+        return "node", None, [type(obj)] + list(obj)
+    if isinstance(obj, Deferred):
+        return "deferred", None, [obj.f, obj.t]
+    if isinstance(obj, Composition):
+        return "compose", None, [obj.first, obj.then]
+    if isinstance(obj, types.FunctionType):
+        if obj.func_code is FIRST:
+            return "curry_first", None, [obj.func_closure[0].cell_contents]
+        if obj.func_code is SECOND:
+            return "curry_second", None, [obj.func_closure[0].cell_contents]
+    elif (hasattr(obj, "__dict__") and not isinstance(obj, Named) and
+          registry.name(type(obj)) is not None):
+        return "object", None, [type(obj), obj.__dict__]
+    raise Unregistered(obj)
+
+
+def freeze(obj, registry):
+    """
+    Freeze something, usually a derivative or a parser's state.
+
+    Raises Unregistered if anything in it can't be frozen.
+    """
+
+    records = []
+    fills = []
+    indices = {}
+    # Records which are being frozen, waiting on what they refer to.
+    open = set()
+    stack = [(obj, False)]
+    # What lazy languages refer to, which may refer back to open records.
+    later = []
+
+    while stack or later:
+        if not stack:
+            stack.append((later.pop(), False))
+        x, ready = stack.pop()
+        if id(x) in indices:
+            continue
+
+        if isinstance(x, Lazy) and registry.name(x) is None:
+            # Lazy languages are made empty and filled in last, since they
+            # are what breaks cycles in the graph.
+            indices[id(x)] = len(records)
+            records.append(("lazy", None, ()))
+            if x.value is not None:
+                fills.append((x, "value", [x.value]))
+            else:
+                f, args = x._thunk
+                fills.append((x, "thunk", [f, args]))
+            later.extend(fills[-1][2])
+            continue
+
+        kind, data, refs = parts(x, registry)
+        if not ready:
+            if id(x) in open:
+                raise Unregistered("Cycle through %r" % (x,))
+            open.add(id(x))
+            stack.append((x, True))
+            stack.extend((y, False) for y in reversed(refs))
+            continue
+
+        open.discard(id(x))
+        indices[id(x)] = len(records)
+        records.append((kind, data, tuple(indices[id(y)] for y in refs)))
+
+    fills = [(indices[id(lazy)], fill, tuple(indices[id(y)] for y in ys))
+             for lazy, fill, ys in fills]
+    return "muffin", VERSION, records, fills, indices[id(obj)]
+
+
+def thaw(frozen, registry):
+    """
+    Thaw something which was frozen, in time proportional to its size.
+
+    Nodes are made in the current context, so they are shared with any
+    living nodes which are the same.
+    """
+
+    tag, version, records, fills, root = frozen
+    if tag != "muffin" or version != VERSION:
+        raise ValueError("Can't thaw version %r of %r" % (version, tag))
+
+    objs = []
+    for kind, data, refs in records:
+        args = [objs[i] for i in refs]
+        if kind == "atom":
+            obj = data
+        elif kind == "name":
+            # A single name, as things were frozen before they could have more.
+            if isinstance(data, basestring):
+                data = data,
+            obj = registry.get(data)
+        elif kind == "tuple":
+            obj = tuple(args)
+        elif kind == "list":
+            obj = args
+        elif kind == "frozenset":
+            obj = frozenset(args)
+        elif kind == "set":
+            obj = set(args)
+        elif kind == "dict":
+            obj = dict(zip(args[::2], args[1::2]))
+        elif kind == "node":
+            obj = args[0](*args[1:])
+        elif kind == "deferred":
+            obj = Deferred(*args)
+        elif kind == "compose":
+            obj = Composition(*args)
+        elif kind == "curry_first":
+            obj = curry_first(*args)
+        elif kind == "curry_second":
+            obj = curry_second(*args)
+        elif kind == "object":
+            cls, d = args
+            obj = cls.__new__(cls)
+            obj.__dict__.update(d)
+        elif kind == "lazy":
+            obj = Lazy.__new__(Lazy)
+        else:
+            raise ValueError("Can't thaw a %r" % kind)
+        objs.append(obj)
+
+    for i, kind, refs in fills:
+        lazy = objs[i]
+        if kind == "value":
+            lazy.fill(objs[refs[0]])
+        else:
+            lazy._thunk = objs[refs[0]], objs[refs[1]]
+
+    return objs[root]
+
+
+# Everything about a parser apart from these is its state.
+SETUP = "scope", "hook"
+
+
+def suspend(parser, registry):
+    """
+    Freeze the state of a Parser, Stream or Document.
+    """
+
+    return freeze(dict((k, v) for k, v in vars(parser).iteritems()
+                       if k not in SETUP), registry)
+
+
+def resume(parser, frozen, registry):
+    """
+    Thaw the state of a parser into a parser made with the same grammar, so
+    that it goes on from where the frozen one stopped.
+    """
+
+    vars(parser).update(thaw(frozen, registry))
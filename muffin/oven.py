@@ -0,0 +1,351 @@
+# Copyright (C) 2014 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+from muffin.pan import (count_parses, force, missing, parses, partition,
+                        rewrite, Alt, Alts, Any, Cat, Cats, Empty, Ex,
+                        Keywords, Lazy, Literal, Node, Null, Red, Rep, Set,
+                        Term)
+
+
+fs = frozenset
+
+
+# Regular expressions over alphabet classes, kept in a normal form so that
+# taking derivatives of them over and over ends up back at the same states.
+
+NONE = "none",
+EPS = "eps",
+
+
+def sym(classes):
+    if not classes:
+        return NONE
+    return "sym", fs(classes)
+
+
+def cat(a, b):
+    if a is NONE or b is NONE:
+        return NONE
+    if a is EPS:
+        return b
+    if b is EPS:
+        return a
+    if a[0] == "cat":
+        return cat(a[1], cat(a[2], b))
+    return "cat", a, b
+
+
+def alt(rs):
+    items = set()
+    for r in rs:
+        if r[0] == "alt":
+            items.update(r[1])
+        elif r is not NONE:
+            items.add(r)
+    if not items:
+        return NONE
+    if len(items) == 1:
+        return items.pop()
+    return "alt", fs(items)
+
+
+def star(r):
+    if r is NONE or r is EPS:
+        return EPS
+    if r[0] == "star":
+        return r
+    return "star", r
+
+
+def nullable(r):
+    if r is EPS or r[0] == "star":
+        return True
+    if r[0] == "cat":
+        return nullable(r[1]) and nullable(r[2])
+    if r[0] == "alt":
+        return any(nullable(x) for x in r[1])
+    return False
+
+
+def derive(r, k):
+    if r[0] == "sym":
+        return EPS if k in r[1] else NONE
+    if r[0] == "cat":
+        d = cat(derive(r[1], k), r[2])
+        if nullable(r[1]):
+            return alt([d, derive(r[2], k)])
+        return d
+    if r[0] == "alt":
+        return alt(derive(x, k) for x in r[1])
+    if r[0] == "star":
+        return cat(derive(r[1], k), r)
+    return NONE
+
+
+def regular(l, seen=None):
+    """
+    Whether a language has no lazy languages, and thus no recursion, in it.
+    """
+
+    if isinstance(l, Lazy):
+        return False
+    if l in (Empty, Null, Any) or isinstance(l, (Ex, Keywords, Literal, Set,
+                                                 Term)):
+        return True
+    if not isinstance(l, (Cat, Cats, Alt, Alts, Rep, Red)):
+        return False
+    if seen is None:
+        seen = {}
+    if id(l) not in seen:
+        seen[id(l)] = all(regular(x, seen) for x in l.languages())
+    return seen[id(l)]
+
+
+def expression(l, classes, count):
+    """
+    Turn a regular language into an expression over alphabet classes.
+    """
+
+    if l is Empty:
+        return NONE
+    if l is Null or isinstance(l, Term):
+        return EPS
+    if l is Any:
+        return sym(range(count))
+    if isinstance(l, Ex):
+        return sym([classes.get(l.c, 0)])
+    if isinstance(l, Set):
+        return sym(classes.get(c, 0) for c in l.s)
+    if isinstance(l, Literal):
+        return word(l.s[l.i:], classes)
+    if isinstance(l, Keywords):
+        return trie(l.trie, classes)
+    if isinstance(l, Red):
+        return expression(l.l, classes, count)
+    if isinstance(l, Rep):
+        return star(expression(l.l, classes, count))
+    if isinstance(l, Alts):
+        return alt([expression(x, classes, count) for x in l.ls])
+    if isinstance(l, Cats):
+        r = EPS
+        for x in reversed(l.ls):
+            r = cat(expression(x, classes, count), r)
+        return r
+    first = expression(l.first, classes, count)
+    second = expression(l.second, classes, count)
+    if isinstance(l, Cat):
+        return cat(first, second)
+    return alt([first, second])
+
+
+def word(s, classes):
+    r = EPS
+    for c in reversed(s):
+        r = cat(sym([classes.get(c, 0)]), r)
+    return r
+
+
+def trie(t, classes):
+    rs = [cat(sym([classes.get(c, 0)]), trie(branch, classes))
+          for c, branch in t.branches.iteritems()]
+    if t.word is not missing:
+        rs.append(EPS)
+    return alt(rs)
+
+
+class DFA(object):
+    """
+    A minimal deterministic automaton for a regular language.
+
+    Transitions into the dead state, from which nothing can be accepted, are
+    None.
+    """
+
+    def __init__(self, l, classes, start, table, accepting):
+        self.l = l
+        self.classes = classes
+        self.start = start
+        self.table = table
+        self.accepting = accepting
+        self.final = fs(state for state in accepting
+                        if not any(n is not None for n in table[state]))
+
+    def step(self, state, c):
+        return self.table[state][self.classes.get(c, 0)]
+
+
+def dfa(l, limit=1000):
+    """
+    Build a minimal DFA for a regular language by taking Brzozowski
+    derivatives until no new states turn up.
+
+    Returns None if the language can't be compiled, or if the DFA would have
+    more than the given number of states.
+    """
+
+    classes = partition(l)
+    if classes is None:
+        return None
+    count = max(classes.values() + [0]) + 1
+
+    start = expression(l, classes, count)
+    states = {start: 0}
+    order = [start]
+    table = []
+    for r in order:
+        row = []
+        for k in range(count):
+            d = derive(r, k)
+            if d not in states:
+                if len(states) >= limit:
+                    return None
+                states[d] = len(order)
+                order.append(d)
+            row.append(states[d])
+        table.append(row)
+    accepting = set(i for i, r in enumerate(order) if nullable(r))
+
+    # Moore's algorithm: split states apart by acceptance, then by which
+    # blocks their transitions lead to, until no block splits.
+    blocks = [int(i in accepting) for i in range(len(order))]
+    while True:
+        signatures = {}
+        refined = []
+        for i, row in enumerate(table):
+            signature = (blocks[i],) + tuple(blocks[n] for n in row)
+            refined.append(signatures.setdefault(signature, len(signatures)))
+        if len(signatures) == len(set(blocks)):
+            break
+        blocks = refined
+
+    # Find the dead block, if there is one, by walking backwards from the
+    # accepting blocks.
+    rows = [None] * len(set(blocks))
+    for i, row in enumerate(table):
+        rows[blocks[i]] = [blocks[n] for n in row]
+    live = set(blocks[i] for i in accepting)
+    changed = True
+    while changed:
+        changed = False
+        for b, row in enumerate(rows):
+            if b not in live and any(n in live for n in row):
+                live.add(b)
+                changed = True
+
+    if blocks[0] not in live:
+        return None
+
+    # Number the live blocks in order, leaving the dead block out.
+    numbers = dict((b, i) for i, b in enumerate(sorted(live)))
+    rows = [[numbers.get(n) for n in rows[b]] for b in sorted(live)]
+    return DFA(l, classes, numbers[blocks[0]], rows,
+               fs(numbers[blocks[i]] for i in accepting))
+
+
+def unwind(seen):
+    terminals = []
+    while seen is not None:
+        c, seen = seen
+        terminals.append(c)
+    terminals.reverse()
+    return terminals
+
+
+class Regular(Node):
+    """
+    A regular language, run by table lookups on a DFA.
+
+    The terminals seen so far are kept, so that parse trees can be made by
+    parsing them with the original language once they are wanted.
+    """
+
+    _fields = "dfa", "state", "seen"
+    # Every step sees a new terminal, so there is nothing to share.
+    _interned = False
+    _alphabet = "original",
+
+    @property
+    def original(self):
+        return self.dfa.l
+
+    def derivative(self, c):
+        state = self.dfa.step(self.state, c)
+        if state is None:
+            return Empty
+        return Regular(self.dfa, state, (c, self.seen))
+
+    def empty(self, f):
+        return False
+
+    def nullable(self, f):
+        return self.state in self.dfa.accepting
+
+    def only_null(self, f):
+        return self.state in self.dfa.final
+
+    def trees(self, f):
+        if self.state not in self.dfa.accepting:
+            return fs()
+        # Parsing the terminals again costs as much as having parsed them
+        # with the original language in the first place, but it is only done
+        # for the derivative whose trees are wanted, once per scope, rather
+        # than on every step. The terminals are kept as pairs, which cost
+        # nothing to extend, and there are no more of them than the trees
+        # would hold anyway.
+        return parses(self.dfa.l, unwind(self.seen))
+
+    def count(self, f):
+        # Trees are reduced, and merge when they reduce to the same value, so
+        # the derivations are counted by parsing again with the original.
+        if self.state not in self.dfa.accepting:
+            return 0
+        return count_parses(self.dfa.l, unwind(self.seen))
+
+    def expected(self, f):
+        row = self.dfa.table[self.state]
+        ts = set(c for c, k in self.dfa.classes.iteritems()
+                 if row[k] is not None)
+        if row[0] is not None:
+            ts.add(Any)
+        return fs(ts)
+
+    def compact(self, f):
+        return self
+
+
+def worthwhile(l):
+    """
+    Whether a regular language is big enough to bother compiling.
+    """
+
+    return (isinstance(l, (Cat, Cats, Alt, Alts, Rep)) or
+            (isinstance(l, Red) and worthwhile(l.l)))
+
+
+def bake(l, limit=1000):
+    """
+    Compile every regular part of a grammar to a DFA.
+
+    Parts which are recursive are left alone, and so are single terminals.
+    """
+
+    seen = {}
+
+    def f(l, g):
+        if regular(l, seen) and worthwhile(l):
+            d = dfa(l, limit)
+            if d is not None:
+                return Regular(d, d.start, None)
+        return l.rebuild(g)
+
+    return rewrite(force(l), f)
@@ -11,12 +11,19 @@
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and limitations
 # under the License.
-from collections import namedtuple
+from collections import defaultdict
 from functools import wraps
+from itertools import islice
+import operator
+import threading
+import time
+import weakref
 
 from pretty import pretty
 
-from muffin.utensils import compose, curry_first, kleene
+from muffin.charclass import CharClass
+from muffin.utensils import (Cache, LRUCache, WeakCache, compose,
+                             curry_first, curry_second, solve)
 
 
 fs = frozenset
@@ -25,26 +32,57 @@ fs = frozenset
 class Recursion(Exception):
     """
     Yo dawg.
+
+    Raised when a derivative is needed in order to compute itself.
     """
 
 
-def key(args, kwargs):
-    return args, fs(kwargs.iteritems())
+class ParseError(Exception):
+    """
+    Raised when a parse can't go on.
+
+    Gives the offset of the terminal which was rejected, or of the end of the
+    input if it ended too soon, along with the terminals which would have
+    been accepted there. Terminals which can't be listed are stood for by
+    Any.
 
+    Streams also give the parse trees of the values which were finished
+    before the rejected terminal, in the same chunk.
+    """
 
-def memo(f):
-    cache = {}
+    def __init__(self, offset, terminal, expected):
+        Exception.__init__(self, offset, terminal, expected)
+        self.offset = offset
+        self.terminal = terminal
+        self.expected = expected
+        self.values = []
 
-    @wraps(f)
-    def inner(*args, **kwargs):
-        k = key(args, kwargs)
-        if k in cache:
-            v = cache[k]
+    def __str__(self):
+        if self.terminal is None:
+            got = "end of input"
         else:
-            v = f(*args, **kwargs)
-            cache[k] = v
-        return v
-    return inner
+            got = repr(self.terminal)
+        return "Unexpected %s at offset %d, expected one of %s" % (
+            got, self.offset, sorted(self.expected))
+
+
+class OverBudget(Exception):
+    """
+    Raised when a parse goes over its budget.
+
+    Gives what ran out and what its limit was, along with the offset which
+    the parse had got to.
+    """
+
+    def __init__(self, resource, limit, offset):
+        Exception.__init__(self, resource, limit, offset)
+        self.resource = resource
+        self.limit = limit
+        self.offset = offset
+
+    def __str__(self):
+        return "Over the budget of %s %s at offset %d" % (
+            self.limit, self.resource, self.offset)
 
 
 class Named(object):
@@ -88,7 +126,15 @@ class Lazy(object):
     def force(self):
         if self.value is None:
             f, args = self._thunk
-            self.value = f(*args)
+            self.fill(f(*args))
+
+    def fill(self, value):
+        """
+        Set the value, letting go of the thunk and everything it refers to.
+        """
+
+        self.value = value
+        self._thunk = None
 
 
 def force(value):
@@ -109,7 +155,7 @@ def could_be_lazy(value):
     Conservative laziness check.
     """
 
-    return isinstance(value, (Lazy, Alt, Cat, Rep))
+    return isinstance(value, (Lazy, Alt, Alts, Cat, Cats, Rep))
 
 
 def lazyd(*args):
@@ -126,8 +172,17 @@ def lazyd(*args):
 
 class PrettyTuple(object):
 
+    _languages = ()
+
     __repr__ = pretty
 
+    def languages(self):
+        """
+        The languages inside this language, unforced.
+        """
+
+        return [getattr(self, field) for field in self._languages]
+
     def __pretty__(self, p, cycle):
         name = type(self).__name__,
         if cycle:
@@ -144,9 +199,118 @@ class PrettyTuple(object):
                 p.pretty(val)
 
 
+class Node(PrettyTuple):
+    """
+    A language with fields.
+
+    Nodes iterate over their fields like namedtuples, and can be weakly
+    referenced. The fields which hold languages are listed separately.
+
+    Nodes are hash-consed: making a node with the same type and fields as a
+    living node in the same context gives back that node. Languages inside a
+    node are told apart by identity, as are any other fields which aren't
+    plain values, so two nodes are equal exactly when they are the same
+    node. Interning keys only hold plain values and ids, so they never keep
+    a node alive.
+    """
+
+    _fields = ()
+    _languages = ()
+    _interned = True
+
+    def __new__(cls, *args):
+        if len(args) != len(cls._fields):
+            raise TypeError("%s takes %d fields (%d given)" %
+                            (cls.__name__, len(cls._fields), len(args)))
+
+        k = None
+        c = context()
+        if cls._interned:
+            k = (cls,) + tuple(map(token, args))
+            node = c.interned.get(k)
+            if node is not None:
+                return node
+
+        node = object.__new__(cls)
+        for field, arg in zip(cls._fields, args):
+            setattr(node, field, arg)
+        if k is not None:
+            c.interned[k] = node
+        budget = c.scopes[-1].budget
+        if budget is not None:
+            budget.made(node)
+        return node
+
+    def __iter__(self):
+        for field in self._fields:
+            yield getattr(self, field)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def rebuild(self, f):
+        """
+        Apply f to every language inside this node.
+
+        Returns this node itself if nothing changed.
+        """
+
+        args = []
+        changed = False
+        for field in self._fields:
+            arg = getattr(self, field)
+            if field in self._languages:
+                new = f(arg)
+                changed = changed or new is not arg
+                arg = new
+            args.append(arg)
+        if not changed:
+            return self
+        return type(self)(*args)
+
+
+# Values which, tagged with their type, are only equal to the same value.
+# Floats aren't, since 0.0 == -0.0.
+VALUES = type(None), bool, int, long, str, unicode, CharClass
+
+
+def token(arg):
+    """
+    The part of a node's interning key which stands for one of its fields.
+
+    Tuples and frozensets, like the parse trees in a Term, are told apart by
+    their members, so that nodes which only hold equal values, rather than
+    the same ones, aren't merged. Anything else which isn't a plain value,
+    like a language, is told apart by identity, so that keys never keep
+    nodes, or the graphs they are part of, alive.
+    """
+
+    if type(arg) in (tuple, frozenset):
+        return type(arg), type(arg)(map(member, arg))
+    return member(arg)
+
+
+def member(x):
+    # Fields are kept alive by the node, so their identities can't be reused
+    # while it is interned.
+    if type(x) in VALUES:
+        return type(x), x
+    return id(x)
+
+
 Patch = Named("Patch")
 
 
+def matched(c):
+    """
+    The derivative of a language which has just parsed a terminal.
+    """
+
+    if current().trees:
+        return Term(fs([c]))
+    return Null
+
+
 class Empty(Named, PrettyTuple):
     """
     The empty set.
@@ -167,6 +331,18 @@ class Empty(Named, PrettyTuple):
     def trees(self, f):
         return fs()
 
+    def count(self, f):
+        return len(self.trees(f))
+
+    def expected(self, f):
+        return fs()
+
+    def rebuild(self, f):
+        return self
+
+    def compact(self, f):
+        return self
+
 
 Empty = Empty("Empty")
 
@@ -191,6 +367,18 @@ class Null(Named, PrettyTuple):
     def trees(self, f):
         return fs([None])
 
+    def count(self, f):
+        return len(self.trees(f))
+
+    def expected(self, f):
+        return fs()
+
+    def rebuild(self, f):
+        return self
+
+    def compact(self, f):
+        return self
+
 
 Null = Null("Null")
 
@@ -201,7 +389,7 @@ class Any(Named, PrettyTuple):
     """
 
     def derivative(self, c):
-        return Term(fs([c]))
+        return matched(c)
 
     def empty(self, f):
         return False
@@ -215,17 +403,31 @@ class Any(Named, PrettyTuple):
     def trees(self, f):
         return fs()
 
+    def count(self, f):
+        return len(self.trees(f))
+
+    def expected(self, f):
+        return fs([Any])
+
+    def rebuild(self, f):
+        return self
+
+    def compact(self, f):
+        return self
+
 
 Any = Any("Any")
 
 
-class Term(PrettyTuple, namedtuple("Term", "ts")):
+class Term(Node):
     """
     A nullable node which has matched a terminal.
 
     Yields terminals when parsing.
     """
 
+    _fields = "ts",
+
     def derivative(self, c):
         return Empty
 
@@ -241,15 +443,26 @@ class Term(PrettyTuple, namedtuple("Term", "ts")):
     def trees(self, f):
         return self.ts
 
+    def count(self, f):
+        return len(self.trees(f))
+
+    def expected(self, f):
+        return fs()
+
+    def compact(self, f):
+        return self
+
 
-class Ex(PrettyTuple, namedtuple("Ex", "c")):
+class Ex(Node):
     """
     Exactly a single terminal.
     """
 
+    _fields = "c",
+
     def derivative(self, c):
         if self.c == c:
-            return Term(fs([c]))
+            return matched(c)
         else:
             return Empty
 
@@ -265,15 +478,52 @@ class Ex(PrettyTuple, namedtuple("Ex", "c")):
     def trees(self, f):
         return fs()
 
+    def count(self, f):
+        return len(self.trees(f))
 
-class Set(PrettyTuple, namedtuple("Set", "s")):
+    def expected(self, f):
+        return fs([self.c])
+
+    def compact(self, f):
+        return self
+
+
+# Character classes with more members than this aren't worth listing.
+LISTABLE = 1024
+
+
+def members(s):
+    """
+    The members of a container of terminals, or None if they can't be
+    listed.
+    """
+
+    if isinstance(s, CharClass) and len(s) > LISTABLE:
+        return None
+    try:
+        return list(s)
+    except TypeError:
+        return None
+
+
+class Set(Node):
     """
     Any member of a container of terminals.
+
+    Strings are made into character classes, so that looking terminals up in
+    them doesn't go through the whole string.
     """
 
+    _fields = "s",
+
+    def __new__(cls, s):
+        if isinstance(s, basestring):
+            s = CharClass.of(s)
+        return Node.__new__(cls, s)
+
     def derivative(self, c):
         if c in self.s:
-            return Term(fs([c]))
+            return matched(c)
         else:
             return Empty
 
@@ -289,14 +539,163 @@ class Set(PrettyTuple, namedtuple("Set", "s")):
     def trees(self, f):
         return fs()
 
+    def count(self, f):
+        return len(self.trees(f))
+
+    def expected(self, f):
+        ts = members(self.s)
+        if ts is None:
+            return fs([Any])
+        return fs(ts)
+
+    def compact(self, f):
+        return self
+
+
+class Literal(Node):
+    """
+    A sequence of terminals, of which the first i have been parsed.
+
+    Yields the entire sequence when parsing.
+    """
+
+    _fields = "s", "i"
+
+    def derivative(self, c):
+        if self.i < len(self.s) and self.s[self.i] == c:
+            if self.i + 1 == len(self.s):
+                return matched(self.s)
+            return Literal(self.s, self.i + 1)
+        else:
+            return Empty
+
+    def empty(self, f):
+        return False
+
+    def nullable(self, f):
+        return self.i == len(self.s)
+
+    def only_null(self, f):
+        return self.i == len(self.s)
+
+    def trees(self, f):
+        if self.i == len(self.s):
+            return fs([self.s])
+        return fs()
+
+    def count(self, f):
+        return len(self.trees(f))
+
+    def expected(self, f):
+        if self.i < len(self.s):
+            return fs([self.s[self.i]])
+        return fs()
+
+    def compact(self, f):
+        if self.i == len(self.s):
+            return matched(self.s)
+        return self
+
+
+class Trie(object):
+    """
+    Sequences of terminals, sharing their prefixes.
+
+    Each branch goes on from one terminal to a trie of what can follow it.
+    The sequence which ends here, if there is one, is kept as the word.
+    """
+
+    def __init__(self):
+        self.branches = {}
+        self.word = missing
+
+    def add(self, s):
+        t = self
+        for c in s:
+            t = t.branches.setdefault(c, Trie())
+        t.word = s
+
+    def terminals(self):
+        """
+        Every terminal in this trie.
+        """
+
+        cs = set()
+        stack = [self]
+        while stack:
+            t = stack.pop()
+            cs.update(t.branches)
+            stack.extend(t.branches.itervalues())
+        return cs
+
+
+class Keywords(Node):
+    """
+    Any of the sequences in a trie.
+
+    Yields whichever entire sequence was parsed. Each terminal costs a single
+    lookup, however many sequences there are.
+    """
+
+    _fields = "trie",
+
+    def derivative(self, c):
+        t = self.trie.branches.get(c)
+        if t is None:
+            return Empty
+        if not t.branches:
+            return matched(t.word)
+        return Keywords(t)
+
+    def empty(self, f):
+        return False
+
+    def nullable(self, f):
+        return self.trie.word is not missing
+
+    def only_null(self, f):
+        return not self.trie.branches
+
+    def trees(self, f):
+        if self.trie.word is not missing:
+            return fs([self.trie.word])
+        return fs()
+
+    def count(self, f):
+        return len(self.trees(f))
+
+    def expected(self, f):
+        return fs(self.trie.branches)
+
+    def compact(self, f):
+        if not self.trie.branches:
+            return matched(self.trie.word)
+        return self
+
+
+def keywords(ss):
+    """
+    Parse any of the given sequences of terminals, looking them up in a trie.
+    """
+
+    if not ss:
+        return Empty
+    trie = Trie()
+    for s in ss:
+        trie.add(s)
+    return Keywords(trie)
+
 
-class Red(PrettyTuple, namedtuple("Red", "l, f")):
+class Red(Node):
     """
     A reduction on languages.
 
     Yields a mapping of input data to output data when parsing.
     """
 
+    _fields = "l", "f"
+    _languages = "l",
+
     def derivative(self, c):
         d = derivative(self.l, c)
 
@@ -304,9 +703,12 @@ class Red(PrettyTuple, namedtuple("Red", "l, f")):
         if empty(d):
             return Empty
 
+        if not current().trees:
+            return d
+
         # Eagerly apply the reduction right now.
         if only_null(d):
-            return Term(fs(self.f(t) for t in trees(d)))
+            return Term(fs(reduction(self.f, t) for t in trees(d)))
 
         # Compose reductions.
         if isinstance(d, Red):
@@ -325,10 +727,151 @@ class Red(PrettyTuple, namedtuple("Red", "l, f")):
 
     def trees(self, f):
         ts = f(self.l)
-        return fs(map(self.f, ts))
+        return fs(reduction(self.f, t) for t in ts)
+
+    def count(self, f):
+        return f(self.l)
+
+    def expected(self, f):
+        return f(self.l)
+
+    def compact(self, f):
+        l = f(self.l)
+
+        if l is Empty:
+            return Empty
+
+        if l is Null or isinstance(l, Term):
+            return Term(fs(reduction(self.f, t) for t in trees(l)))
+
+        if isinstance(l, Red):
+            return Red(l.l, compose(l.f, self.f))
+
+        if l is self.l:
+            return self
+        return Red(l, self.f)
+
+
+class Deferred(object):
+    """
+    A reduction which hasn't been applied to a parse tree yet.
+    """
+
+    __slots__ = "f", "t", "_hash"
+
+    def __init__(self, f, t):
+        self.f = f
+        self.t = t
+        self._hash = hash((id(f), t))
+
+    def __eq__(self, other):
+        return (isinstance(other, Deferred) and self.f is other.f and
+                self.t == other.t)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return self._hash
+
+    def __repr__(self):
+        return "Deferred(%r, %r)" % (self.f, self.t)
+
+
+def reduction(f, t):
+    """
+    Apply a reduction to a parse tree, or put it off if the scope says so.
+    """
+
+    if current().defer:
+        return Deferred(f, t)
+    return f(t)
+
+
+def realize(tree):
+    """
+    Apply every deferred reduction in a parse tree, innermost first.
+
+    Reductions which had a tree built into them, like those which put null
+    parses in front of others, can return trees with deferred reductions of
+    their own, so what they return is realized in turn. Trees can be very
+    deep, so this walks them without recursing.
+    """
+
+    done = {}
+    results = {}
+    stack = [(tree, False)]
+    while stack:
+        t, ready = stack.pop()
+        if id(t) in done:
+            continue
+        if id(t) in results:
+            # Results are kept, so that their ids can't be reused.
+            done[id(t)] = done[id(results[id(t)])]
+        elif isinstance(t, Deferred):
+            if not ready:
+                stack.append((t, True))
+                stack.append((t.t, False))
+            else:
+                v = t.f(done[id(t.t)])
+                results[id(t)] = v
+                stack.append((t, True))
+                stack.append((v, False))
+        elif type(t) is tuple:
+            if not ready:
+                stack.append((t, True))
+                stack.extend((child, False) for child in t)
+            else:
+                done[id(t)] = tuple(done[id(child)] for child in t)
+        else:
+            done[id(t)] = t
+    return done[id(tree)]
+
+
+class Delta(Node):
+    """
+    The null parses of a language.
+
+    Only parses the null string, yielding the parse trees which the language
+    would have yielded for the null string, without working them out yet.
+    """
+
+    _fields = "l",
+    _languages = "l",
+
+    def derivative(self, c):
+        return Empty
+
+    def empty(self, f):
+        return not nullable(self.l)
 
+    def nullable(self, f):
+        return f(self.l)
+
+    def only_null(self, f):
+        return True
+
+    def trees(self, f):
+        return f(self.l)
+
+    def count(self, f):
+        return f(self.l)
+
+    def expected(self, f):
+        return fs()
+
+    def compact(self, f):
+        l = f(self.l)
+
+        if l is Empty or l is Null or isinstance(l, (Term, Delta)):
+            return l
+
+        if l is self.l:
+            return self
+        return Delta(l)
 
-class Cat(PrettyTuple, namedtuple("Cat", "first, second")):
+
+class Cat(Node):
     """
     Concatenation of parsers.
 
@@ -337,6 +880,9 @@ class Cat(PrettyTuple, namedtuple("Cat", "first, second")):
     This object's fields must be lazy.
     """
 
+    _fields = "first", "second"
+    _languages = "first", "second"
+
     def derivative(self, c):
         # Do some eager compaction here. Doing the test for emptiness is fine;
         # at this point, we've been forced and we're gonna do a nullability
@@ -348,20 +894,29 @@ class Cat(PrettyTuple, namedtuple("Cat", "first, second")):
             return Empty
 
         fd = derivative(self.first, c)
-        sd = lazyd(self.second, c)
 
         l = Cat(fd, self.second)
 
-        # Add in the second part if the first part's nullable.
+        # Add in the second part if the first part's nullable. Unless the
+        # first part is done and has only a few parse trees, its trees are
+        # left to be worked out once they're wanted, since they could be
+        # very many.
         if nullable(self.first):
-            ts = trees(self.first)
-            partial = Cat(Term(ts), sd)
-
-            if only_null(self.first):
-                if not ts:
-                    partial = Red(sd, curry_first(None))
-                elif len(ts) == 1:
+            sd = lazyd(self.second, c)
+            if sd is Empty:
+                return l
+            if not current().trees and not current().counts:
+                partial = sd
+            elif current().counts:
+                partial = Cat(Delta(self.first), sd)
+            elif only_null(self.first) and few(self.first):
+                ts = trees(self.first)
+                if len(ts) == 1:
                     partial = Red(sd, curry_first(list(ts)[0]))
+                else:
+                    partial = Cat(Term(ts), sd)
+            else:
+                partial = Cat(Delta(self.first), sd)
 
             return Alt(l, partial)
         else:
@@ -374,13 +929,49 @@ class Cat(PrettyTuple, namedtuple("Cat", "first, second")):
         return all(f(l) for l in self)
 
     def only_null(self, f):
-        return all(f(l) for l in self)
+        # The second part is usually the older and better known of the two.
+        return f(self.second) and f(self.first)
 
     def trees(self, f):
         return fs((x, y) for x in f(self.first) for y in f(self.second))
 
+    def count(self, f):
+        return f(self.first) * f(self.second)
+
+    def expected(self, f):
+        if nullable(self.first):
+            return f(self.first) | f(self.second)
+        return f(self.first)
+
+    def compact(self, f):
+        first = f(self.first)
+        second = f(self.second)
 
-class Alt(PrettyTuple, namedtuple("Alt", "first, second")):
+        if first is Empty or second is Empty:
+            return Empty
+
+        # Null prefixes and suffixes become reductions, or vanish if there are
+        # no trees to keep.
+        if not current().trees:
+            if first is Null:
+                return second
+            if second is Null:
+                return first
+        x = single(first)
+        y = single(second)
+        if x is not missing:
+            if y is not missing:
+                return Term(fs([(x, y)]))
+            return Red(second, curry_first(x))
+        if y is not missing:
+            return Red(first, curry_second(y))
+
+        if first is self.first and second is self.second:
+            return self
+        return Cat(first, second)
+
+
+class Alt(Node):
     """
     Alternation or union of parsers.
 
@@ -389,6 +980,9 @@ class Alt(PrettyTuple, namedtuple("Alt", "first, second")):
     This object's fields must be lazy.
     """
 
+    _fields = "first", "second"
+    _languages = "first", "second"
+
     def derivative(self, c):
         # Do some compaction.
         fd = lazyd(self.first, c)
@@ -418,106 +1012,1507 @@ class Alt(PrettyTuple, namedtuple("Alt", "first, second")):
     def trees(self, f):
         return f(self.first) | f(self.second)
 
+    def count(self, f):
+        return f(self.first) + f(self.second)
+
+    def expected(self, f):
+        return f(self.first) | f(self.second)
+
+    def compact(self, f):
+        first = f(self.first)
+        second = f(self.second)
+
+        if first is Empty:
+            return second
+        if second is Empty:
+            return first
+        # Counting keeps both ways of parsing, even when they are the same.
+        if current().merge:
+            if first is second:
+                return first
+            if isinstance(first, Term) and isinstance(second, Term):
+                return Term(first.ts | second.ts)
+
+        if first is self.first and second is self.second:
+            return self
+        return Alt(first, second)
 
-class Rep(PrettyTuple, namedtuple("Rep", "l")):
+
+class Alts(Node):
     """
-    Kleene star of a parser.
+    Alternation of any number of parsers.
 
-    Parses all repetitions, but only yields the least repetition when emitting
-    final parse trees.
+    Yields all succeeding components when parsing, like a chain of Alts, but
+    takes the derivatives of all of them in one go, rather than down a
+    spine of nested nodes.
 
     This object's fields must be lazy.
     """
 
-    def derivative(self, c):
-        # Do some compaction.
-        if self.l is Empty:
-            return Empty
+    _fields = "ls",
 
-        def repeat(xy):
-            x, y = xy
-            if y is None:
-                return (x,)
-            return (x,) + y
+    def languages(self):
+        return list(self.ls)
 
-        # Cat needs to be lazy here too, since the inner language might not
-        # yet be forced. Remember that Rep is lazy too!
-        return Red(Cat(lazyd(self.l, c), self), repeat)
+    def rebuild(self, f):
+        ls = tuple(f(l) for l in self.ls)
+        if all(x is y for x, y in zip(ls, self.ls)):
+            return self
+        return Alts(ls)
+
+    def derivative(self, c):
+        # Do some compaction, dropping the parsers which can't match.
+        ds = []
+        for l in self.ls:
+            if not empty(l):
+                d = lazyd(l, c)
+                if d is not Empty:
+                    ds.append(d)
+
+        if not ds:
+            return Empty
+        if len(ds) == 1:
+            return ds[0]
+        return Alts(tuple(ds))
 
     def empty(self, f):
-        return f(self.l)
+        return all(f(l) for l in self.ls)
 
     def nullable(self, f):
-        return True
+        return any(f(l) for l in self.ls)
 
     def only_null(self, f):
-        return False
+        return all(f(l) for l in self.ls)
 
     def trees(self, f):
-        return fs([None])
-
+        return fs().union(*[f(l) for l in self.ls])
+
+    def count(self, f):
+        return sum(f(l) for l in self.ls)
+
+    def expected(self, f):
+        return fs().union(*[f(l) for l in self.ls])
+
+    def compact(self, f):
+        ls = []
+        ts = []
+        seen = set()
+        merge = current().merge
+        for l in self.ls:
+            l = f(l)
+            if l is Empty:
+                continue
+            # Counting keeps every way of parsing, even the same one twice.
+            if not merge:
+                ls.append(l)
+            elif isinstance(l, Term):
+                ts.append(l)
+            elif id(l) not in seen:
+                seen.add(id(l))
+                ls.append(l)
+
+        # Null parses all end up in one place.
+        if len(ts) == 1:
+            ls.append(ts[0])
+        elif ts:
+            ls.append(Term(fs().union(*[t.ts for t in ts])))
+
+        if not ls:
+            return Empty
+        if len(ls) == 1:
+            return ls[0]
 
-@memo
-def derivative(l, c):
-    return force(l).derivative(c)
+        ls = tuple(ls)
+        if ls == self.ls:
+            return self
+        return Alts(ls)
 
 
-@kleene(True)
-def empty(f):
-    def inner(l):
-        return force(l).empty(f)
-    return inner
+class Cats(Node):
+    """
+    Concatenation of any number of parsers.
 
+    Yields the product of its components when parsing, nested to the left
+    like a chain of Cats would be. The components are kept side by side,
+    rather than down a spine of nested nodes, and components which are done
+    parsing are kept at the front, with their parse trees.
 
-@kleene(False)
-def nullable(f):
-    def inner(l):
-        return force(l).nullable(f)
-    return inner
+    This object's fields must be lazy.
+    """
 
+    _fields = "ls",
 
-@kleene(True)
-def only_null(f):
-    def inner(l):
-        return force(l).only_null(f)
-    return inner
+    def languages(self):
+        return list(self.ls)
 
+    def rebuild(self, f):
+        ls = tuple(f(l) for l in self.ls)
+        if all(x is y for x, y in zip(ls, self.ls)):
+            return self
+        return Cats(ls)
 
-@kleene(fs())
-def trees(f):
-    def inner(l):
-        return force(l).trees(f)
-    return inner
+    def derivative(self, c):
+        # Do some eager compaction here, as Cat does.
+        if empty(self):
+            return Empty
 
+        # Take the derivative of each component in turn, for as long as the
+        # ones before it could be done, keeping their null parses in front.
+        ds = []
+        done = ()
+        for i, l in enumerate(self.ls):
+            d = derivative(l, c) if i == 0 else lazyd(l, c)
+            if d is not Empty:
+                ds.append(Cats(done + (d,) + self.ls[i + 1:]))
+            if not nullable(l):
+                break
+            if not current().trees and not current().counts:
+                continue
+            if l is Null or isinstance(l, (Term, Delta)):
+                done += l,
+            elif only_null(l) and few(l) and not current().counts:
+                done += Term(trees(l)),
+            else:
+                done += Delta(l),
+
+        if not ds:
+            return Empty
+        if len(ds) == 1:
+            return ds[0]
+        return Alts(tuple(ds))
 
-@kleene(0)
-def length(f):
-    def inner(l):
-        try:
-            return sum(f(x) for x in force(l)) + 1
-        except TypeError:
-            return 1
-    return inner
+    def empty(self, f):
+        return any(f(l) for l in self.ls)
 
+    def nullable(self, f):
+        return all(f(l) for l in self.ls)
 
-def cd(l, c):
-    print "~ Derivative for", repr(c)
-    d = derivative(l, c)
-    # print d
-    print "~ Size:", length(d)
-    return d
+    def only_null(self, f):
+        # The last components are usually the oldest and best known.
+        return all(f(l) for l in reversed(self.ls))
 
+    def trees(self, f):
+        ts = f(self.ls[0])
+        for l in self.ls[1:]:
+            ts = fs((x, y) for x in ts for y in f(l))
+        return ts
+
+    def count(self, f):
+        n = 1
+        for l in self.ls:
+            n *= f(l)
+        return n
+
+    def expected(self, f):
+        ts = fs()
+        for l in self.ls:
+            ts |= f(l)
+            if not nullable(l):
+                break
+        return ts
+
+    def compact(self, f):
+        ls = [f(l) for l in self.ls]
+
+        if Empty in ls:
+            return Empty
+
+        if not current().trees:
+            ls = [l for l in ls if l is not Null] or [Null]
+        else:
+            # A component at the front with only one parse tree becomes a
+            # reduction on the one after it.
+            while len(ls) > 1 and single(ls[0]) is not missing:
+                x = single(ls[0])
+                y = single(ls[1])
+                if y is not missing:
+                    ls[:2] = [Term(fs([(x, y)]))]
+                elif isinstance(ls[1], Red):
+                    ls[:2] = [Red(ls[1].l, compose(ls[1].f, curry_first(x)))]
+                else:
+                    ls[:2] = [Red(ls[1], curry_first(x))]
+
+        if len(ls) == 1:
+            return ls[0]
+        if len(ls) == 2:
+            return Cat(ls[0], ls[1]).compact(f)
+
+        ls = tuple(ls)
+        if all(x is y for x, y in zip(ls, self.ls)):
+            return self
+        return Cats(ls)
+
+
+class Rep(Node):
+    """
+    Kleene star of a parser.
+
+    Parses all repetitions, but only yields the least repetition when emitting
+    final parse trees.
+
+    This object's fields must be lazy.
+    """
+
+    _fields = "l",
+    _languages = "l",
+
+    def derivative(self, c):
+        # Do some compaction.
+        if self.l is Empty:
+            return Empty
+
+        # Cat needs to be lazy here too, since the inner language might not
+        # yet be forced. Remember that Rep is lazy too!
+        if not current().trees:
+            return Cat(lazyd(self.l, c), self)
+        # Gather the rest of the repetitions as pairs, which cost nothing to
+        # extend, and only turn them into a tuple once.
+        return Red(Cat(lazyd(self.l, c), Many(self.l)), items)
+
+    def empty(self, f):
+        # There are no repetitions of nothing, but there is still the least.
+        return False
+
+    def nullable(self, f):
+        return True
+
+    def only_null(self, f):
+        return False
+
+    def trees(self, f):
+        return fs([None])
+
+    def count(self, f):
+        return len(self.trees(f))
+
+    def expected(self, f):
+        return f(self.l)
+
+    def compact(self, f):
+        l = f(self.l)
+
+        if l is Empty:
+            return Null
+
+        if l is self.l:
+            return self
+        return type(self)(l)
+
+
+class Many(Rep):
+    """
+    Kleene star of a parser, yielding repetitions as pairs.
+
+    Each repetition is a pair of its first item and the rest of the
+    repetition, and the least repetition is None. Use items() to turn these
+    into tuples.
+    """
+
+    def derivative(self, c):
+        if self.l is Empty:
+            return Empty
+
+        return Cat(lazyd(self.l, c), self)
+
+
+def items(pairs):
+    """
+    Turn a repetition of pairs, as yielded by Many, into a tuple.
+    """
+
+    x, rest = pairs
+    items = [x]
+    while rest is not None:
+        x, rest = rest
+        items.append(x)
+    return tuple(items)
+
+
+class Budget(object):
+    """
+    Limits on what a single parse may take: how many nodes it may keep
+    alive, how many derivatives it may take, how many parse trees any
+    language may have, and how many seconds it may run for. Limits which are
+    None aren't kept to.
+
+    What has been spent is counted as the parse goes, without walking the
+    graph. Live nodes are counted by watching every node which is made
+    until it is collected, so limiting them costs a little more than the
+    rest.
+    """
+
+    # Derivatives taken between looks at the clock.
+    TICK = 64
+
+    def __init__(self, nodes=None, derivatives=None, trees=None,
+                 seconds=None):
+        self.nodes = nodes
+        self.derivatives = derivatives
+        self.trees = trees
+        self.seconds = seconds
+
+        self.live = 0
+        self.taken = 0
+        self.offset = 0
+        self.deadline = None
+        self._refs = set()
+
+    def start(self):
+        """
+        A fresh copy of this budget, with nothing spent yet.
+        """
+
+        budget = Budget(self.nodes, self.derivatives, self.trees,
+                        self.seconds)
+        if self.seconds is not None:
+            budget.deadline = time.time() + self.seconds
+        return budget
+
+    def over(self, resource, limit):
+        raise OverBudget(resource, limit, self.offset)
+
+    def made(self, node):
+        if self.nodes is not None:
+            self.live += 1
+            if self.live > self.nodes:
+                self.over("nodes", self.nodes)
+            self._refs.add(weakref.ref(node, self._collected))
+        if self.trees is not None and isinstance(node, Term):
+            self.spend_trees(len(node.ts))
+
+    def _collected(self, ref):
+        self.live -= 1
+        self._refs.discard(ref)
+
+    def derived(self):
+        self.taken += 1
+        if self.derivatives is not None and self.taken > self.derivatives:
+            self.over("derivatives", self.derivatives)
+        if not self.taken % self.TICK:
+            self.tick()
+
+    def spend_trees(self, n):
+        if self.trees is not None and n > self.trees:
+            self.over("trees", self.trees)
+
+    def reach(self, offset):
+        """
+        Note how far the parse has got, and check the clock.
+        """
+
+        self.offset = offset
+        self.tick()
+
+    def tick(self):
+        if self.deadline is not None and time.time() > self.deadline:
+            self.over("seconds", self.seconds)
+
+
+class Scope(object):
+    """
+    The derivatives and properties computed during a single parse.
+
+    Derivatives must be shared for as long as any derivative made with them
+    is alive, so a scope's own cache is never bounded. A weak scope lets a
+    derivative go once either it or the language it was taken of is no longer
+    in use; nothing is lost by this, since a derivative which is taken again
+    cannot be a part of any living graph. A longer-lived shared cache can be
+    consulted as well: a LRUCache keeps a bounded number of derivatives
+    between parses, and a WeakCache keeps them for as long as they are alive.
+
+    If the scope knows the alphabet classes of the grammar being parsed,
+    derivatives which come out empty are remembered for every terminal in the
+    same class at once, as are all derivatives if the scope only recognizes.
+
+    A scope which isn't keeping trees takes derivatives which only recognize
+    their sequences, without building anything for the parse trees. A scope
+    which counts doesn't keep trees either, but keeps the null parses of
+    every way of parsing apart, so that none of them are merged before they
+    are counted. A scope which doesn't merge keeps them apart when compacting
+    too, but still keeps trees; counting never merges. A scope which defers
+    reductions builds trees with Deferred reductions in them, which are only
+    applied by realize() to the trees which are finally wanted.
+
+    A scope with a budget spends its own copy of it, and raises OverBudget
+    once it runs out.
+
+    Scopes are entered with the with statement.
+    """
+
+    def __init__(self, shared=None, weak=False, classes=None, trees=True,
+                 counts=False, merge=True, defer=False, budget=None,
+                 grammar=None):
+        self.cache = WeakCache() if weak else Cache()
+        self.shared = shared
+        self.classes = classes
+        self.trees = trees and not counts
+        self.counts = counts
+        self.merge = merge and not counts
+        self.defer = defer
+        self.budget = None if budget is None else budget.start()
+        # The grammar is kept alive, so that the ids of its languages, which
+        # their properties are known by, can't be reused.
+        self.grammar = grammar
+        self.known = precomputed(grammar) or {}
+        self.forget()
+        self.pending = set()
+        self.compacted = WeakCache()
+
+    def __enter__(self):
+        context().scopes.append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        context().scopes.pop()
+
+    def forget(self):
+        """
+        Drop remembered properties, which can always be worked out again.
+
+        Properties which are known ahead of time, for compiled grammars, are
+        kept.
+        """
+
+        self.properties = defaultdict(dict)
+        for name, values in self.known.iteritems():
+            self.properties[name] = Properties(values)
+
+
+class Properties(dict):
+    """
+    Properties of languages, by id, which fall back on those which are known
+    ahead of time, without copying them.
+    """
+
+    def __init__(self, known):
+        dict.__init__(self)
+        self.known = known
+
+    def __contains__(self, k):
+        return dict.__contains__(self, k) or k in self.known
+
+    def __missing__(self, k):
+        return self.known[k]
+
+
+class ParseContext(object):
+    """
+    Everything which parsing keeps track of, apart from the grammar.
+
+    Each thread has a context of its own, made the first time it is needed,
+    so that parses in different threads never touch the same caches.
+    Grammars hold no state of their own once they are tied, and can be
+    shared between threads freely; caches passed to parses can't, unless
+    every thread has its own. Another context can be entered with the with
+    statement, to keep parses apart within a thread too.
+
+    A context holds its stack of scopes, the living nodes which nodes are
+    hash-consed against, and what has been worked out once per grammar: its
+    alphabet classes, its recognizer and, for muffin.bran, compiled patterns.
+    """
+
+    def __init__(self):
+        # The bottom scope catches derivatives taken outside of any parse.
+        self.scopes = [Scope()]
+        # Every living node, by type and fields. A node keeps its fields
+        # alive, so identities in its key can't be reused while it is here.
+        self.interned = weakref.WeakValueDictionary()
+        self.alphabets = WeakCache(weak_values=False)
+        self.recognizers = WeakCache(weak_values=False)
+        self.patterns = LRUCache(100)
+
+    def __enter__(self):
+        contexts().append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        contexts().pop()
+
+
+local = threading.local()
+
+
+def contexts():
+    """
+    The contexts which this thread has entered, innermost last.
+    """
+
+    try:
+        return local.contexts
+    except AttributeError:
+        local.contexts = [ParseContext()]
+        return local.contexts
+
+
+def context():
+    """
+    This thread's current context.
+    """
+
+    return contexts()[-1]
+
+
+def current():
+    """
+    The innermost scope of this thread's current context.
+    """
+
+    try:
+        return local.contexts[-1].scopes[-1]
+    except AttributeError:
+        return context().scopes[-1]
+
+
+def scope(shared=None, l=None, trees=True, counts=False, defer=False,
+          budget=None):
+    """
+    Open a fresh scope for derivatives, to be discarded once it is exited.
+
+    If a grammar is given, its alphabet classes are used, along with what
+    was worked out when it was compiled.
+    """
+
+    if l is None:
+        return Scope(shared, trees=trees, counts=counts, defer=defer,
+                     budget=budget)
+    return Scope(shared, classes=alphabet(l), trees=trees, counts=counts,
+                 defer=defer, budget=budget, grammar=l)
+
+
+missing = Named("missing")
+
+
+def derivative(l, c):
+    s = current()
+    l = force(l)
+    k = l, c
+    v = s.cache.get(k, missing)
+    if v is missing:
+        if s.classes is not None:
+            # Empty derivatives carry no terminals, so they are the same
+            # across a class, and so are all the derivatives of a scope which
+            # only recognizes; these keys can't clash with per-terminal ones.
+            # Other derivatives hold the terminal in their trees, so they
+            # stay per terminal.
+            kc = l, None, s.classes.get(c, 0)
+            v = s.cache.get(kc, missing)
+            if v is not missing:
+                return v
+        # Shared caches may be used by scopes which derive differently.
+        ks = l, c, s.trees, s.counts, s.defer
+        if s.shared is not None:
+            v = s.shared.get(ks, missing)
+        if v is missing:
+            if k in s.pending:
+                raise Recursion(k)
+            s.pending.add(k)
+            if s.budget is not None:
+                s.budget.derived()
+            try:
+                v = l.derivative(c)
+            finally:
+                s.pending.discard(k)
+            if s.shared is not None:
+                s.shared[ks] = v
+        recognizing = not s.trees and not s.counts
+        if s.classes is not None and (v is Empty or recognizing):
+            s.cache[kc] = v
+        else:
+            s.cache[k] = v
+    return v
+
+
+def partition(l):
+    """
+    Split the alphabet into classes of terminals which the grammar cannot
+    tell apart.
+
+    Returns a dictionary of terminals to class numbers; every terminal which
+    is not mentioned by the grammar is in class zero. If the grammar has a
+    set of terminals which can't be listed, returns None.
+    """
+
+    sets = []
+    seen = set()
+    stack = [l]
+    while stack:
+        node = force(stack.pop())
+        if id(node) in seen:
+            continue
+        seen.add(id(node))
+        if isinstance(node, Ex):
+            sets.append([node.c])
+        elif isinstance(node, Literal):
+            sets.extend([c] for c in node.s[node.i:])
+        elif isinstance(node, Keywords):
+            sets.extend([c] for c in node.trie.terminals())
+        elif isinstance(node, Set):
+            ts = members(node.s)
+            if ts is None:
+                return None
+            sets.append(ts)
+        else:
+            # Nodes which stand in for other languages, without holding them
+            # as children, list them as their alphabet instead.
+            if hasattr(node, "_alphabet"):
+                stack.extend(getattr(node, field) for field in node._alphabet)
+            else:
+                stack.extend(node.languages())
+
+    signatures = defaultdict(set)
+    for i, terminals in enumerate(sets):
+        for c in terminals:
+            signatures[c].add(i)
+
+    numbers = {fs(): 0}
+    classes = {}
+    for c, signature in signatures.iteritems():
+        signature = fs(signature)
+        if signature not in numbers:
+            numbers[signature] = len(numbers)
+        classes[c] = numbers[signature]
+    return classes
+
+
+def alphabet(l):
+    """
+    The alphabet classes of a grammar, worked out once per grammar.
+    """
+
+    alphabets = context().alphabets
+    classes = alphabets.get((l,), missing)
+    if classes is missing:
+        classes = alphabets[l,] = partition(l)
+    return classes
+
+
+def single(l):
+    """
+    The only parse tree of a language which only parses the null string, if
+    it is that simple.
+    """
+
+    if l is Null:
+        return None
+    if isinstance(l, Term) and len(l.ts) == 1:
+        return list(l.ts)[0]
+    return missing
+
+
+same = Named("same")
+
+
+def rewrite(l, f, done=None):
+    """
+    Rewrite a graph of languages.
+
+    f is called with each language and a function for rewriting the
+    languages inside it, and returns the rewritten language. Lazy languages
+    which have not been forced yet are left alone, and those which have are
+    kept lazy around their rewritten values, since they are what breaks
+    cycles in the graph.
+
+    Rewritten languages are remembered in done, a weak cache, and are taken
+    to need no further rewriting. Passing the same cache to later rewrites
+    lets them skip parts of the graph which have already been seen.
+    """
+
+    if done is None:
+        done = WeakCache()
+
+    def g(l):
+        v = done.get((l,), missing)
+        if v is same:
+            return l
+        if v is not missing:
+            return v
+
+        if isinstance(l, Lazy):
+            if l.value is None:
+                return l
+            # Record the new lazy language before looking inside, in case
+            # the graph cycles back around to it.
+            lazy = Lazy(g, l.value)
+            done[l,] = lazy
+            v = g(l.value)
+            lazy.fill(v)
+            if v is l.value:
+                v = l
+            else:
+                v = lazy
+        else:
+            v = f(l, g)
+
+        # The cache is weak, so nothing may refer to its own key.
+        if v is l:
+            done[l,] = same
+        else:
+            done[l,] = v
+            done[v,] = same
+        return v
+
+    return g(l)
+
+
+def compact(l):
+    """
+    Simplify a language throughout its graph.
+
+    Compacted languages are remembered in the current scope, so that parts of
+    the graph which survive from one step to the next are only compacted
+    once.
+    """
+
+    return rewrite(l, lambda l, f: l.compact(f), current().compacted)
+
+
+def recognizer(l):
+    """
+    A language which parses the same sequences as the given language, but
+    has no parse trees worth speaking of.
+
+    Reductions are dropped and null parses carry no trees, so recognizing
+    with it doesn't do any work for the sake of trees. It is made once per
+    language.
+    """
+
+    recognizers = context().recognizers
+    r = recognizers.get((l,), missing)
+    if r is same:
+        return l
+    if r is missing:
+        def f(l, g):
+            if isinstance(l, Red):
+                return g(l.l)
+            if isinstance(l, Term):
+                return Null
+            return l.rebuild(g)
+
+        r = rewrite(l, f)
+        # The cache is weak, so nothing may refer to its own key.
+        recognizers[l,] = same if r is l else r
+    return r
+
+
+def resolve(l):
+    """
+    Force a language, unless it is a derivative which is still being taken.
+    """
+
+    try:
+        return force(l)
+    except Recursion:
+        return l
+
+
+def fixpoint(bottom, pending=None):
+    """
+    Turn a rule into a property of languages which is solved across the
+    graph by iteration to a fixed point.
+
+    Derivatives which are still being taken cannot be looked into yet, and
+    are assumed to have the pending value, which defaults to the bottom
+    value. Properties are kept in the current scope.
+    """
+
+    if pending is None:
+        pending = bottom
+
+    def first(f):
+        name = f.__name__
+
+        def rule(l, get):
+            if isinstance(l, Lazy):
+                return pending
+            return f(l, lambda x: get(resolve(x)))
 
-def parses(l, s):
-    for c in s:
-        l = cd(l, c)
-    return trees(l)
+        def known(l):
+            return not isinstance(l, Lazy)
 
+        @wraps(f)
+        def second(l):
+            values = current().properties[name]
+            return solve(resolve(l), bottom, rule, values, known)
+        return second
+    return first
 
-def matches(l, s):
-    for c in s:
-        l = cd(l, c)
-    return nullable(l)
+
+@fixpoint(True, pending=False)
+def empty(l, f):
+    return l.empty(f)
+
+
+@fixpoint(False)
+def nullable(l, f):
+    return l.nullable(f)
+
+
+@fixpoint(True, pending=False)
+def only_null(l, f):
+    return l.only_null(f)
+
+
+@fixpoint(fs())
+def trees(l, f):
+    ts = l.trees(f)
+    budget = current().budget
+    if budget is not None:
+        budget.spend_trees(len(ts))
+    return ts
+
+
+@fixpoint(fs())
+def expected(l, f):
+    return l.expected(f)
+
+
+# How many parse trees are few enough to be worth working out eagerly.
+FEW = 8
+
+
+@fixpoint(0)
+def estimate(l, f):
+    return min(l.count(f), FEW)
+
+
+def few(l):
+    """
+    Whether a language has only a few parse trees.
+
+    Trees are counted with multiplicity, without building them, so this
+    errs on the side of too many.
+    """
+
+    return estimate(l) < FEW
+
+
+@fixpoint(0)
+def derivations(l, f):
+    # Languages which can't parse the null string have nothing to count, and
+    # counting inside them could go around a cycle forever.
+    if not nullable(l):
+        return 0
+    return l.count(f)
+
+
+def nullables(l):
+    """
+    The nullable languages which the parse count of a language depends on.
+    """
+
+    found = []
+
+    def f(child):
+        child = resolve(child)
+        if nullable(child):
+            found.append(child)
+        return 0
+
+    if not isinstance(l, Lazy):
+        l.count(f)
+    return found
+
+
+def loops(l):
+    """
+    Whether a language can parse the null string in infinitely many ways,
+    by going around a cycle of nullable languages.
+    """
+
+    l = resolve(l)
+    if not nullable(l):
+        return False
+
+    # Depth-first, keeping the current path; a language which is seen on the
+    # path again closes a cycle.
+    done = set()
+    path = set([id(l)])
+    stack = [(l, iter(nullables(l)))]
+    while stack:
+        node, children = stack[-1]
+        for child in children:
+            if id(child) in path:
+                return True
+            if id(child) not in done:
+                path.add(id(child))
+                stack.append((child, iter(nullables(child))))
+                break
+        else:
+            stack.pop()
+            path.discard(id(node))
+            done.add(id(node))
+    return False
+
+
+def count(l):
+    """
+    The number of ways a language can parse the null string.
+
+    Parse trees are counted before any reductions, so trees which reduce to
+    the same value are counted separately. Counts are exact, however large
+    they get; if there are infinitely many ways, returns infinity.
+    """
+
+    if loops(l):
+        return float("inf")
+    return derivations(l)
+
+
+def products(tss):
+    """
+    The products of the parse trees of the parts of a concatenation, nested
+    to the left, built only as they are iterated over.
+    """
+
+    # Without this, every product of the parts in front would be gone
+    # through only to find nothing to pair them with.
+    if not all(tss):
+        return
+    if len(tss) == 1:
+        for x in tss[0]:
+            yield x
+        return
+    for x in products(tss[:-1]):
+        for y in tss[-1]:
+            yield x, y
+
+
+def some(l, k):
+    """
+    Up to k of the parse trees of a language, without building the rest.
+
+    Every language has at most k trees worked out for it, and keeps the ones
+    it already has, so this is solved like trees(). Concatenations only build
+    as many of their products as they keep, so the work for each language is
+    bounded by k and the number of its parts.
+    """
+
+    def rule(l, get):
+        if isinstance(l, Lazy):
+            return fs()
+        ts = get(l)
+        if len(ts) >= k:
+            return ts
+        f = lambda x: get(resolve(x))
+        if isinstance(l, (Cat, Cats)):
+            new = products([f(part) for part in l.languages()])
+        else:
+            new = l.trees(f)
+        return ts | fs(islice((t for t in new if t not in ts), k - len(ts)))
+
+    return solve(resolve(l), fs(), rule, {})
+
+
+class Forest(object):
+    """
+    The parse trees of a language, which are only built once they are
+    wanted.
+
+    Derivatives leave the null parses of their parts as Delta languages
+    rather than working them out, so the final derivative shares every
+    sub-parse and packs every ambiguity, however many trees they make up.
+    Asking for a few trees only builds a few trees for each part; iterating
+    over the forest builds them in rounds, twice as many each time, until
+    there are no more.
+    """
+
+    def __init__(self, l, scope):
+        self.l = l
+        self.scope = scope
+
+    def __iter__(self):
+        seen = set()
+        k = 1
+        while True:
+            ts = self.take(k)
+            for t in ts:
+                if t not in seen:
+                    seen.add(t)
+                    yield t
+            if len(ts) < k:
+                return
+            k *= 2
+
+    def take(self, k):
+        """
+        Return a list of up to k parse trees.
+        """
+
+        with self.scope:
+            ts = some(self.l, k)
+        if self.scope.defer:
+            return [realize(t) for t in ts]
+        return list(ts)
+
+    def first(self):
+        """
+        Return one parse tree.
+
+        Raises ValueError if there are none.
+        """
+
+        for t in self.take(1):
+            return t
+        raise ValueError("No parse trees")
+
+
+def length(l):
+    """
+    Count the languages in a graph.
+
+    Languages are counted once each, however many times they are shared, and
+    lazy languages are not forced.
+    """
+
+    seen = set()
+    stack = [l]
+    while stack:
+        node = stack.pop()
+        if id(node) in seen:
+            continue
+        seen.add(id(node))
+        if isinstance(node, Lazy):
+            if node.value is not None:
+                stack.append(node.value)
+        else:
+            stack.extend(node.languages())
+    return len(seen)
+
+
+def trace(i, c, d):
+    """
+    A hook which prints every step of a parse, along with the size of the
+    derivative.
+
+    Measuring the derivative walks the entire graph, so this is only for
+    debugging.
+    """
+
+    print "~ Derivative for", repr(c)
+    print "~ Size:", length(d)
+
+
+def run(l, s, hook=None, every=1):
+    """
+    Take the derivative of a language with respect to every terminal of a
+    sequence in turn.
+
+    The derivative is compacted after every so many steps; pass zero to never
+    compact. If given, the hook is called after every step with the offset,
+    the terminal, and the new derivative.
+
+    Stops with a ParseError as soon as a terminal leaves nothing that could
+    be parsed.
+    """
+
+    return advance(l, s, hook, every)[0]
+
+
+def advance(l, s, hook=None, every=1):
+    """
+    Like run(), but also return how many terminals there were, so that
+    sequences which are only iterated over can still be told where they
+    ended.
+    """
+
+    n = 0
+    for i, c in enumerate(s):
+        d = step(l, i, c, every)
+        # Derivatives which are still lazy, or weren't compacted, can be
+        # empty without being Empty, so it has to be worked out.
+        if empty(d):
+            raise ParseError(i, c, expected(l))
+        l = d
+        if hook is not None:
+            hook(i, c, l)
+        n = i + 1
+    return l, n
+
+
+def accept(l, s, hook=None):
+    """
+    Take the derivative of a language with respect to a sequence, which must
+    be parsed in its entirety.
+
+    Raises ParseError if it isn't.
+    """
+
+    l, n = advance(l, s, hook)
+    if not nullable(l):
+        raise ParseError(n, None, expected(l))
+    return l
+
+
+def step(l, i, c, every=1):
+    """
+    Take the derivative of a language with respect to the terminal at offset
+    i, compacting it if it is due.
+    """
+
+    budget = current().budget
+    if budget is not None:
+        budget.reach(i)
+    l = derivative(l, c)
+    if every and not (i + 1) % every:
+        l = compact(l)
+    if budget is not None:
+        budget.reach(i + 1)
+    return l
+
+
+class Parser(object):
+    """
+    A parser which is fed its input a piece at a time.
+
+    Only the current derivative is kept, and derivatives are cached weakly, so
+    memory use follows the size of the derivative rather than the length of
+    the input. Deferring reductions gives that up, since the derivative then
+    holds on to whatever the reductions will need.
+    """
+
+    def __init__(self, l, cache=None, hook=None, every=1, defer=False,
+                 budget=None):
+        self.l = l
+        self.scope = Scope(cache, weak=True, classes=alphabet(l), defer=defer,
+                           budget=budget, grammar=l)
+        self.hook = hook
+        self.every = every
+        self.offset = 0
+
+    def feed(self, chunk):
+        """
+        Parse a chunk of input.
+
+        Raises ParseError at the first terminal which can't be parsed, leaving
+        the parser as it was before that terminal.
+        """
+
+        with self.scope:
+            for c in chunk:
+                l = step(self.l, self.offset, c, self.every)
+                # Derivatives aren't always compacted, so whether they are
+                # empty has to be worked out.
+                if empty(l):
+                    raise ParseError(self.offset, c, expected(self.l))
+                self.l = l
+                if self.hook is not None:
+                    self.hook(self.offset, c, self.l)
+                self.offset += 1
+        self.scope.forget()
+
+    def is_viable(self):
+        """
+        Whether any further input could still be accepted.
+        """
+
+        with self.scope:
+            return not empty(self.l)
+
+    def is_accepting(self):
+        """
+        Whether the input so far is accepted.
+        """
+
+        with self.scope:
+            return nullable(self.l)
+
+    def finish(self):
+        """
+        Return the parse trees for the input so far.
+        """
+
+        with self.scope:
+            ts = trees(self.l)
+        if self.scope.defer:
+            ts = fs(realize(t) for t in ts)
+        return ts
+
+    def forest(self):
+        """
+        Return a forest of the parse trees for the input so far.
+        """
+
+        return Forest(self.l, self.scope)
+
+
+class Stream(object):
+    """
+    A parser for a stream of values, one after another, which is fed its
+    input a piece at a time.
+
+    Each value is parsed as far as it can go. It is finished once it can't
+    be carried on any further, or once the next terminal can only start a
+    new value. Terminals which are between values are skipped.
+    """
+
+    def __init__(self, l, between=(), cache=None, hook=None, every=1):
+        self.start = l
+        self.between = between
+        self.scope = Scope(cache, weak=True, classes=alphabet(l), grammar=l)
+        self.hook = hook
+        self.every = every
+        self.l = None
+        self.offset = 0
+
+    def feed(self, chunk):
+        """
+        Parse a chunk of input, returning the parse trees of every value
+        which was finished in it.
+
+        Raises ParseError at the first terminal which can't be parsed,
+        leaving the stream as it was before that terminal. Values finished
+        earlier in the same chunk are given with the error.
+        """
+
+        values = []
+        with self.scope:
+            try:
+                self.parse(chunk, values)
+            except ParseError as e:
+                e.values = values
+                raise
+        self.scope.forget()
+        return values
+
+    def parse(self, chunk, values):
+        """
+        Parse a chunk of input, adding the parse trees of every value which
+        was finished in it to a list as it goes.
+        """
+
+        for c in chunk:
+            if self.l is None:
+                if c in self.between:
+                    self.offset += 1
+                    continue
+                self.l = self.start
+            # Derivatives aren't always compacted, so whether they are
+            # empty has to be worked out.
+            l = step(self.l, self.offset, c, self.every)
+            if empty(l) and self.l is not self.start and nullable(self.l):
+                # The value is as long as it gets; start on the next.
+                if c in self.between:
+                    values.append(trees(self.l))
+                    self.l = None
+                    self.offset += 1
+                    continue
+                l = step(self.start, self.offset, c, self.every)
+                if empty(l):
+                    raise ParseError(self.offset, c, expected(self.l) |
+                                     expected(self.start))
+                values.append(trees(self.l))
+            elif empty(l):
+                raise ParseError(self.offset, c, expected(self.l))
+            self.l = l
+            if self.hook is not None:
+                self.hook(self.offset, c, self.l)
+            self.offset += 1
+            if only_null(self.l):
+                values.append(trees(self.l))
+                self.l = None
+
+    def pieces(self, chunk, every):
+        """
+        Parse a chunk of input a few terminals at a time, yielding the parse
+        trees of the values finished in each piece.
+
+        Between pieces, control goes back to whatever is iterating, so an
+        event loop can let other work run instead of waiting for a long
+        chunk to be parsed all at once.
+        """
+
+        for i in range(0, len(chunk), every):
+            yield self.feed(chunk[i:i + every])
+
+    def finish(self):
+        """
+        Finish the stream, returning the parse trees of the value which was
+        still being parsed, if any.
+
+        Raises ParseError if that value isn't finished.
+        """
+
+        values = []
+        if self.l is not None:
+            with self.scope:
+                if not nullable(self.l):
+                    raise ParseError(self.offset, None, expected(self.l))
+                values.append(trees(self.l))
+            self.l = None
+        return values
+
+
+def values(l, chunks, between=()):
+    """
+    Parse a stream of values out of an iterable of chunks of input, such as
+    the reads from a socket, yielding the parse trees of each value as soon
+    as it is finished.
+
+    Raises ParseError if the input can't be parsed.
+    """
+
+    stream = Stream(l, between)
+    for chunk in chunks:
+        error = None
+        try:
+            done = stream.feed(chunk)
+        except ParseError as e:
+            done, error = e.values, e
+        for ts in done:
+            yield ts
+        if error is not None:
+            raise error
+    for ts in stream.finish():
+        yield ts
+
+
+class Document(object):
+    """
+    A document which is parsed again after every edit, starting from where
+    the edit was rather than from the beginning.
+
+    The derivative after some terminals depends on nothing else, so a
+    checkpoint of it is kept every so many terminals, and an edit only
+    throws away the checkpoints after it. Parsing picks up from the last
+    checkpoint which is left, so it takes time in proportion to how far the
+    edit was from the end.
+
+    If a limit is given, whenever there would be more checkpoints than that,
+    every other one is dropped and the spacing doubles, so that long
+    documents don't keep more than limit derivatives around.
+    """
+
+    def __init__(self, l, text="", spacing=64, limit=None, cache=None,
+                 hook=None, every=1):
+        self.text = text
+        self.spacing = spacing
+        self.limit = limit
+        self.scope = Scope(cache, weak=True, classes=alphabet(l), grammar=l)
+        self.hook = hook
+        self.every = every
+        self.checkpoints = [(0, l)]
+        self.l = None
+
+    def edit(self, start, end, replacement):
+        """
+        Replace the text between two offsets.
+        """
+
+        self.text = self.text[:start] + replacement + self.text[end:]
+        while self.checkpoints[-1][0] > start:
+            self.checkpoints.pop()
+        self.l = None
+
+    def parse(self):
+        """
+        Take the derivative with respect to the text after the last
+        checkpoint, leaving checkpoints along the way.
+
+        Raises ParseError at the first terminal which can't be parsed; the
+        checkpoints before it are kept.
+        """
+
+        offset, l = self.checkpoints[-1]
+        with self.scope:
+            for i in xrange(offset, len(self.text)):
+                c = self.text[i]
+                d = step(l, i, c, self.every)
+                # Derivatives aren't always compacted, so whether they are
+                # empty has to be worked out.
+                if empty(d):
+                    raise ParseError(i, c, expected(l))
+                l = d
+                if self.hook is not None:
+                    self.hook(i, c, l)
+                if not (i + 1) % self.spacing:
+                    l = compact(l)
+                    self.checkpoints.append((i + 1, l))
+                    if (self.limit is not None and
+                        len(self.checkpoints) > self.limit):
+                        self.checkpoints = self.checkpoints[::2]
+                        self.spacing *= 2
+        self.scope.forget()
+        self.l = l
+
+    def trees(self):
+        """
+        Return the parse trees for the whole text.
+
+        Raises ParseError if it can't be parsed.
+        """
+
+        if self.l is None:
+            self.parse()
+        with self.scope:
+            if not nullable(self.l):
+                raise ParseError(len(self.text), None, expected(self.l))
+            ts = trees(self.l)
+        self.scope.forget()
+        return ts
+
+
+def parses(l, s, cache=None, hook=None, defer=False, budget=None):
+    """
+    Parse a sequence, returning all of the parse trees.
+
+    Derivatives are only kept for the duration of the parse, unless a shared
+    cache is given to hold some of them for later parses.
+
+    Reductions are normally applied as soon as they can be. If they are
+    deferred, they are only applied to the trees which are returned, which
+    saves work when many of them would have been thrown away.
+
+    Raises ParseError if the sequence can't be parsed, and OverBudget if a
+    budget is given and the parse goes over it.
+    """
+
+    with scope(cache, l, defer=defer, budget=budget):
+        ts = trees(accept(l, s, hook))
+    if defer:
+        ts = fs(realize(t) for t in ts)
+    return ts
+
+
+def forest(l, s, cache=None, hook=None, defer=False, budget=None):
+    """
+    Parse a sequence, returning a forest of the parse trees, for when there
+    are too many parse trees to build them all.
+
+    Raises ParseError if the sequence can't be parsed, and OverBudget if a
+    budget is given and the parse goes over it.
+    """
+
+    with scope(cache, l, defer=defer, budget=budget) as current:
+        return Forest(accept(l, s, hook), current)
+
+
+def count_parses(l, s, cache=None, hook=None, budget=None):
+    """
+    Parse a sequence, returning the number of parse trees without building
+    any of them.
+    """
+
+    with scope(cache, l, counts=True, budget=budget):
+        try:
+            return count(run(l, s, hook))
+        except ParseError:
+            return 0
+
+
+def matches(l, s, cache=None, hook=None, budget=None):
+    """
+    Recognize a sequence.
+
+    Only the language's recognizer is used, and no trees are built, so the
+    hook sees derivatives of that rather than of the language itself.
+    """
+
+    l = recognizer(l)
+    with scope(cache, l, trees=False, budget=budget):
+        try:
+            return nullable(run(l, s, hook))
+        except ParseError:
+            return False
 
 
 def patch(lazy, names):
@@ -531,13 +2526,158 @@ def rec(name):
 
 
 def tie(obj, names):
+    seen = set()
     s = [obj]
     while s:
         node = s.pop()
-        if not isinstance(node, (Cat, Alt, Rep)):
+        if not isinstance(node, Node) or id(node) in seen:
             continue
-        for item in node:
+        seen.add(id(node))
+        for item in node.languages():
             if isinstance(item, Lazy):
                 patch(item, names)
             elif item is not obj:
                 s.append(item)
+
+
+# Compiled grammars, along with the properties of their languages. Grammars
+# are shared between threads, so these aren't kept in a context; they are
+# dropped along with their grammars instead, so the properties only refer to
+# the languages weakly.
+compiled = WeakCache(weak_values=False)
+
+
+def precomputed(l):
+    """
+    The properties which were worked out when a grammar was compiled, if it
+    was.
+    """
+
+    return compiled.get((l,))
+
+
+def prune(l, f):
+    # Languages which can't parse anything are cut off, along with whatever
+    # only they led to.
+    if empty(l):
+        return Empty
+    return l.compact(f)
+
+
+def char_class(l):
+    """
+    The characters which a language is any one of, as a CharClass, or None
+    if it isn't that simple.
+    """
+
+    if isinstance(l, Ex) and isinstance(l.c, basestring) and len(l.c) == 1:
+        return CharClass.of(l.c)
+    if isinstance(l, Set) and isinstance(l.s, CharClass):
+        return l.s
+    return None
+
+
+def flatten(l, f):
+    if isinstance(l, (Alt, Alts)):
+        # Alternatives which are the same are kept, since each is another way
+        # of parsing, which count_parses() counts.
+        ls = []
+        for x in l.languages():
+            x = f(x)
+            ls.extend(x.languages() if isinstance(x, (Alt, Alts)) else [x])
+
+        # Single characters which are alternatives to each other yield the
+        # same trees as a class of them, which takes one lookup, so long as
+        # no character is in more than one of them.
+        chars = [item for item in ls if char_class(item) is not None]
+        classes = map(char_class, chars)
+        if (len(chars) > 1 and
+            len(reduce(operator.or_, classes)) == sum(map(len, classes))):
+            i = ls.index(chars[0])
+            ls = [item for item in ls if char_class(item) is None]
+            ls.insert(i, Set(reduce(operator.or_, classes)))
+
+        # Nodes are hash-consed, so anything which didn't change comes back
+        # as itself.
+        if len(ls) == 1:
+            return ls[0]
+        if len(ls) == 2:
+            return Alt(*ls)
+        return Alts(tuple(ls))
+
+    if isinstance(l, (Cat, Cats)):
+        # Only the first component can be spread out, since Cats nests its
+        # trees to the left.
+        ls = [f(child) for child in l.languages()]
+        if isinstance(ls[0], (Cat, Cats)):
+            ls[:1] = ls[0].languages()
+        if len(ls) == 2:
+            return Cat(*ls)
+        return Cats(tuple(ls))
+
+    return l.rebuild(f)
+
+
+def compile_grammar(l):
+    """
+    Optimize a tied grammar, once, before parsing with it.
+
+    Every rec in the grammar has to have been tied. Languages which can't
+    parse anything are pruned, which leaves unreachable whatever only they
+    led to, and the rest is compacted, so that reductions of constants are
+    worked out and reductions of reductions are composed. Alternations, and
+    concatenations which nest to the left, are flattened into Alts and Cats.
+    Every lazy language is filled, leaving nothing to force. Nothing is
+    merged which would change how many ways there are of parsing, so
+    count_parses() gives the same counts either way.
+
+    Whether each language in the grammar is empty, nullable, or only null is
+    worked out now, and handed to every scope which parses the grammar
+    rather than being worked out again in each of them.
+
+    Returns the compiled grammar, which is a new graph; the old one is left
+    as it was.
+
+    Raises ValueError if a rec was never tied.
+    """
+
+    seen = set()
+    stack = [l]
+    while stack:
+        node = stack.pop()
+        if id(node) in seen:
+            continue
+        seen.add(id(node))
+        if isinstance(node, Lazy):
+            if node.value is None:
+                raise ValueError("Untied language %r" % (node,))
+            stack.append(node.value)
+        else:
+            stack.extend(node.languages())
+
+    # Alternatives are left as they are, so that compiled grammars have as
+    # many ways of parsing as the grammars they were compiled from.
+    with Scope(merge=False):
+        l = force(rewrite(force(l), prune))
+        l = force(rewrite(l, flatten))
+
+    with Scope() as s:
+        seen = set()
+        stack = [l]
+        while stack:
+            node = resolve(stack.pop())
+            if id(node) in seen:
+                continue
+            seen.add(id(node))
+            empty(node)
+            nullable(node)
+            only_null(node)
+            stack.extend(node.languages())
+        known = {}
+        for f in empty, nullable, only_null:
+            values = s.properties[f.__name__]
+            known[f.__name__] = dict((i, (weakref.ref(node), v))
+                                     for i, (node, v) in values.iteritems())
+
+    compiled[l,] = known
+    return l
@@ -0,0 +1,106 @@
+# Copyright (C) 2014 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+from unittest import TestCase
+
+from muffin.bran import compile, purge
+from muffin.pan import context, matches, parses, ParseError
+
+
+fs = frozenset
+
+
+class TestCompile(TestCase):
+
+    def assertMatches(self, pattern, s):
+        self.assertEqual(parses(compile(pattern), s), fs([s]))
+
+    def test_literal(self):
+        self.assertMatches("abc", "abc")
+
+    def test_alternation(self):
+        self.assertMatches("ab|cd", "cd")
+
+    def test_empty(self):
+        self.assertMatches("", "")
+
+    def test_star(self):
+        self.assertMatches("a*", "aaa")
+        self.assertMatches("a*", "")
+
+    def test_plus(self):
+        self.assertMatches("a+b", "aab")
+        self.assertFalse(matches(compile("a+b"), "b"))
+
+    def test_optional(self):
+        self.assertMatches("ab?c", "ac")
+
+    def test_counted(self):
+        self.assertMatches("a{2}", "aa")
+        self.assertMatches("a{2,}", "aaaa")
+        self.assertMatches("a{1,3}", "aaa")
+        self.assertFalse(matches(compile("a{1,3}"), "aaaa"))
+
+    def test_lazy(self):
+        self.assertMatches("a+?", "aa")
+
+    def test_group(self):
+        self.assertMatches("(ab|cd)*", "abcdab")
+        self.assertMatches("(?:a|b)c", "bc")
+
+    def test_class(self):
+        self.assertMatches("[a-c_]+", "ab_c")
+        self.assertFalse(matches(compile("[a-c_]"), "d"))
+
+    def test_class_dashes(self):
+        self.assertMatches("[-a]", "-")
+        self.assertMatches("[a-]", "-")
+
+    def test_inverted(self):
+        self.assertMatches("[^a-c]", "d")
+        self.assertMatches("[^a-c]", u"\u2603")
+        self.assertFalse(matches(compile("[^a-c]"), "b"))
+
+    def test_escapes(self):
+        self.assertMatches("\\d+\\.\\d+", "3.14")
+        self.assertMatches("\\w\\s\\W", "a\t-")
+        self.assertMatches("a\\nb", "a\nb")
+
+    def test_dot(self):
+        self.assertMatches("a.c", "abc")
+        self.assertFalse(matches(compile("a.c"), "a\nc"))
+
+    def test_number(self):
+        l = compile("-?(0|[1-9][0-9]*)(\\.[0-9]+)?([eE][-+]?[0-9]+)?")
+        for s in "0", "-12", "3.25", "1e+10", "-4.5E-2":
+            self.assertEqual(parses(l, s), fs([s]))
+        self.assertFalse(matches(l, "01"))
+
+    def test_bad(self):
+        for pattern in "a**", "(a", "[]", "\\b", "a{", "^a":
+            self.assertRaises(ParseError, compile, pattern)
+
+    def test_bad_repeat(self):
+        self.assertRaises(ValueError, compile, "x{2,1}")
+        self.assertMatches("x{2,2}", "xx")
+
+
+class TestCache(TestCase):
+
+    def test_cached(self):
+        self.assertTrue(compile("[a-z]+") is compile("[a-z]+"))
+
+    def test_purge(self):
+        compile("x")
+        purge()
+        self.assertEqual(len(context().patterns), 0)
@@ -0,0 +1,66 @@
+# Copyright (C) 2014 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+from unittest import TestCase
+
+from muffin.charclass import CharClass
+
+
+class TestCharClass(TestCase):
+
+    def test_ranges(self):
+        k = CharClass.of("cabxyz")
+        self.assertEqual(k.ranges, ((97, 99), (120, 122)))
+
+    def test_contains(self):
+        k = CharClass.of("abc")
+        self.assertTrue("b" in k)
+        self.assertFalse("d" in k)
+
+    def test_contains_not_a_char(self):
+        k = CharClass.of("abc")
+        self.assertFalse("ab" in k)
+        self.assertFalse(None in k)
+
+    def test_unicode(self):
+        k = CharClass.between(u"\u0391", u"\u03a9")
+        self.assertTrue(u"\u03a3" in k)
+        self.assertFalse(u"\u03b1" in k)
+        self.assertFalse("a" in k)
+
+    def test_invert(self):
+        k = ~CharClass.of("abc")
+        self.assertFalse("a" in k)
+        self.assertTrue("d" in k)
+        self.assertEqual(len(k), 253)
+
+    def test_invert_unicode(self):
+        k = ~CharClass.of(u"abc")
+        self.assertTrue(u"\u2603" in k)
+        self.assertEqual(~k, CharClass.of(u"abc"))
+
+    def test_union(self):
+        k = CharClass.between("a", "f") | CharClass.between("d", "z")
+        self.assertEqual(k, CharClass.between("a", "z"))
+
+    def test_intersection(self):
+        k = CharClass.between("a", "m") & CharClass.of("kmnop")
+        self.assertEqual(k, CharClass.of("km"))
+
+    def test_difference(self):
+        k = CharClass.between("a", "e") - CharClass.of("bd")
+        self.assertEqual(list(k), ["a", "c", "e"])
+
+    def test_iter(self):
+        self.assertEqual(list(CharClass.of("cba")), ["a", "b", "c"])
+        self.assertEqual(list(CharClass.of(u"ab")), [u"a", u"b"])
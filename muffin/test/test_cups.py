@@ -13,8 +13,8 @@
 # under the License.
 from unittest import TestCase
 
-from muffin.cups import Optional, Sep, String
-from muffin.pan import parses, Cat, Ex
+from muffin.cups import All, Any, Optional, Sep, String
+from muffin.pan import parses, Alts, Cat, Ex, Keywords, ParseError
 
 
 fs = frozenset
@@ -68,6 +68,40 @@ class TestSep(TestCase):
         self.assertEqual(parses(l, i), e)
 
 
+class TestAny(TestCase):
+
+    def test_many(self):
+        l = Any([Ex("a"), Ex("b"), Ex("c"), Ex("d")])
+        for c in "abcd":
+            self.assertEqual(parses(l, c), fs([c]))
+
+    def test_literals(self):
+        l = Any([String("true"), String("false"), String("null")])
+        self.assertTrue(isinstance(l, Keywords))
+        self.assertEqual(parses(l, "null"), fs(["null"]))
+
+    def test_literals_and_others(self):
+        l = Any([Ex("x"), String("if"), String("in"), Ex("y")])
+        self.assertTrue(isinstance(l, Alts))
+        self.assertEqual(parses(l, "in"), fs(["in"]))
+        self.assertEqual(parses(l, "y"), fs(["y"]))
+
+
+class TestAll(TestCase):
+
+    def test_many(self):
+        l = All([Ex("a"), Ex("b"), Ex("c"), Ex("d")])
+        i = "abcd"
+        e = fs([((("a", "b"), "c"), "d")])
+        self.assertEqual(parses(l, i), e)
+
+    def test_optional(self):
+        l = All([Ex("a"), Optional(Ex("b")), Ex("c")])
+        i = "ac"
+        e = fs([(("a", None), "c")])
+        self.assertEqual(parses(l, i), e)
+
+
 class TestString(TestCase):
 
     def test_char(self):
@@ -79,8 +113,7 @@ class TestString(TestCase):
     def test_char_fail(self):
         l = String("a")
         i = "b"
-        e = set()
-        self.assertEqual(parses(l, i), e)
+        self.assertRaises(ParseError, parses, l, i)
 
     def test_string(self):
         l = String("abc")
@@ -91,11 +124,20 @@ class TestString(TestCase):
     def test_string_fail_first(self):
         l = String("abc")
         i = "dbc"
-        e = set()
-        self.assertEqual(parses(l, i), e)
+        try:
+            parses(l, i)
+        except ParseError as pe:
+            self.assertEqual(pe.offset, 0)
+        else:
+            self.fail("Parsed %r" % i)
 
     def test_string_fail_last(self):
         l = String("abc")
         i = "abd"
-        e = set()
-        self.assertEqual(parses(l, i), e)
+        try:
+            parses(l, i)
+        except ParseError as pe:
+            self.assertEqual(pe.offset, 2)
+            self.assertEqual(pe.expected, fs(["c"]))
+        else:
+            self.fail("Parsed %r" % i)
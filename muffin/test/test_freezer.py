@@ -0,0 +1,138 @@
+# Copyright (C) 2014 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import marshal
+from unittest import TestCase
+
+from muffin.berry.json import value
+from muffin.berry.sexp import sexp
+from muffin.freezer import (freeze, resume, suspend, thaw, Registry,
+                            Unregistered)
+from muffin.pan import (parses, Cat, Document, Ex, Lazy, ParseContext, Parser,
+                        Red, Stream, derivative)
+from muffin.utensils import compose, curry_first
+
+
+def thawed(frozen, registry):
+    # Go through marshal, and a context of its own, as another process would.
+    with ParseContext():
+        return thaw(marshal.loads(marshal.dumps(frozen)), registry)
+
+
+class TestFreeze(TestCase):
+
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_data(self):
+        x = (1, [u"a", None], frozenset(["b"]), {"c": 2.5})
+        self.assertEqual(thawed(freeze(x, self.registry), self.registry), x)
+
+    def test_sharing(self):
+        xs = [1]
+        ys = thawed(freeze((xs, xs), self.registry), self.registry)
+        self.assertIs(ys[0], ys[1])
+
+    def test_cycle(self):
+        lazy = Lazy(derivative, Ex("a"), "a")
+        l = Cat(Ex("b"), lazy)
+        lazy.fill(l)
+        thawed_l = thawed(freeze(l, self.registry), self.registry)
+        self.assertIs(thawed_l.second.value, thawed_l)
+
+    def test_thunk(self):
+        l = thawed(freeze(Lazy(derivative, Ex("a"), "a"), self.registry),
+                   self.registry)
+        self.assertEqual(l._thunk[0], derivative)
+        self.assertEqual(l._thunk[1][1], "a")
+
+    def test_reductions(self):
+        f = compose(curry_first(1), curry_first(2))
+        g = thawed(freeze(f, self.registry), self.registry)
+        self.assertEqual(g(3), (2, (1, 3)))
+
+    def test_grammar(self):
+        self.registry.grammar("sexp", sexp)
+        self.assertEqual(thawed(freeze(sexp, self.registry), self.registry),
+                         sexp)
+
+    def test_unregistered(self):
+        l = Red(Ex("a"), lambda x: x)
+        self.assertRaises(Unregistered, freeze, l, self.registry)
+
+    def test_unknown(self):
+        frozen = "muffin", 1, [("name", "nowhere", ())], [], 0
+        self.assertRaises(Unregistered, thaw, frozen, self.registry)
+
+
+class TestSuspend(TestCase):
+
+    def setUp(self):
+        self.registry = Registry()
+        self.registry.grammar("json", value)
+        self.registry.grammar("sexp", sexp)
+
+    def test_parser(self):
+        s = '[{"a":[1,2,"x"]},{"b":[true,null]},3]'
+        p = Parser(value)
+        p.feed(s[:17])
+        frozen = marshal.loads(marshal.dumps(suspend(p, self.registry)))
+        with ParseContext():
+            q = Parser(value)
+            resume(q, frozen, self.registry)
+            q.feed(s[17:])
+            self.assertEqual(q.finish(), parses(value, s))
+            self.assertEqual(q.offset, len(s))
+
+    def test_uncompacted(self):
+        s = "(a (b c) (d (e)))"
+        p = Parser(sexp, every=0)
+        p.feed(s[:9])
+        frozen = suspend(p, self.registry)
+        with ParseContext():
+            q = Parser(sexp, every=0)
+            resume(q, frozen, self.registry)
+            q.feed(s[9:])
+            self.assertEqual(q.finish(), parses(sexp, s))
+
+    def test_stream(self):
+        st = Stream(sexp, " ")
+        self.assertEqual(st.feed("(a) (b"), [frozenset([("a",)])])
+        frozen = suspend(st, self.registry)
+        with ParseContext():
+            other = Stream(sexp, " ")
+            resume(other, frozen, self.registry)
+            self.assertEqual(other.feed(" c)"), [frozenset([("b", "c")])])
+
+    def test_other_grammars(self):
+        p = Parser(sexp)
+        p.feed("(a (b")
+        frozen = suspend(p, self.registry)
+        # Only some of the grammars, registered in another order.
+        registry = Registry()
+        registry.grammar("sexp", sexp)
+        with ParseContext():
+            q = Parser(sexp)
+            resume(q, marshal.loads(marshal.dumps(frozen)), registry)
+            q.feed(" c))")
+            self.assertEqual(q.finish(), frozenset([("a", ("b", "c"))]))
+
+    def test_document(self):
+        d = Document(sexp, "(a b)", spacing=2)
+        d.trees()
+        frozen = suspend(d, self.registry)
+        with ParseContext():
+            other = Document(sexp)
+            resume(other, frozen, self.registry)
+            other.edit(3, 4, "(c)")
+            self.assertEqual(other.trees(), frozenset([("a", ("c",))]))
@@ -0,0 +1,111 @@
+# Copyright (C) 2014 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+from unittest import TestCase
+
+from muffin.berry.json import number
+from muffin.cups import Sep
+from muffin.oven import bake, dfa, regular, Regular
+from muffin.pan import (count_parses, matches, parses, rec, tie, Alt, Cat,
+                        Empty, Ex, Null, ParseError, Red, Rep, Set)
+
+
+class TestRegular(TestCase):
+
+    def test_rep(self):
+        self.assertTrue(regular(Rep(Ex("a"))))
+
+    def test_lazy(self):
+        self.assertFalse(regular(Alt(Ex("a"), rec("l"))))
+
+
+class TestDFA(TestCase):
+
+    def test_minimal(self):
+        # a*a* and a* are the same language, with a single state.
+        l = Cat(Rep(Ex("a")), Rep(Ex("a")))
+        d = dfa(l)
+        self.assertEqual(len(d.table), 1)
+        self.assertEqual(d.accepting, frozenset([d.start]))
+
+    def test_dead(self):
+        d = dfa(Cat(Ex("a"), Ex("b")))
+        self.assertEqual(d.step(d.start, "b"), None)
+        self.assertEqual(d.step(d.start, "z"), None)
+
+    def test_final(self):
+        d = dfa(Cat(Ex("a"), Ex("b")))
+        state = d.step(d.step(d.start, "a"), "b")
+        self.assertTrue(state in d.final)
+
+    def test_empty(self):
+        self.assertEqual(dfa(Empty), None)
+
+    def test_limit(self):
+        l = Cat(Rep(Alt(Ex("a"), Ex("b"))), Cat(Ex("a"), Alt(Ex("a"),
+                                                             Ex("b"))))
+        self.assertEqual(dfa(l, limit=2), None)
+        self.assertNotEqual(dfa(l), None)
+
+
+class TestBake(TestCase):
+
+    def test_whole(self):
+        l = bake(Rep(Set("ab")))
+        self.assertTrue(isinstance(l, Regular))
+
+    def test_number(self):
+        l = bake(number)
+        self.assertTrue(isinstance(l, Regular))
+        for s in "0", "-12", "3.25", "1e+10", "-4.5E-2":
+            self.assertEqual(parses(l, s), parses(number, s))
+        self.assertFalse(matches(l, "1."))
+
+    def test_count(self):
+        one = lambda _: 1
+        l = Cat(Alt(Red(Ex("a"), one), Red(Set("ab"), one)), Rep(Ex("b")))
+        baked = bake(l)
+        self.assertTrue(isinstance(baked, Regular))
+        for s in "a", "ab", "abb", "b":
+            self.assertEqual(count_parses(baked, s), count_parses(l, s))
+        self.assertEqual(count_parses(baked, "ab"), 2)
+
+    def test_classes(self):
+        # The baked language has no terminals of its own for the alphabet
+        # classes to be made from.
+        l = Cat(bake(Rep(Set("ab"))), Ex("c"))
+        self.assertTrue(matches(l, "abc"))
+        self.assertFalse(matches(l, "adc"))
+
+    def test_recursive(self):
+        word = Red(Rep(Set("ab")), lambda t: "".join(t or ()))
+        nested = Alt(Cat(Ex("("), Cat(Sep(word, Ex(" ")), Ex(")"))),
+                     Cat(Ex("("), Cat(rec("nested"), Ex(")"))))
+        tie(nested, {"nested": nested})
+        baked = bake(nested)
+        self.assertFalse(isinstance(baked, Regular))
+        s = "((ab ba))"
+        self.assertEqual(parses(baked, s), parses(nested, s))
+
+    def test_expected(self):
+        l = bake(Cat(Ex("a"), Set("bc")))
+        try:
+            parses(l, "ad")
+        except ParseError as pe:
+            self.assertEqual(pe.expected, frozenset("bc"))
+        else:
+            self.fail("Parsed")
+
+    def test_null(self):
+        l = bake(Alt(Null, Rep(Ex("a"))))
+        self.assertEqual(parses(l, ""), parses(Alt(Null, Rep(Ex("a"))), ""))
@@ -11,9 +11,21 @@
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and limitations
 # under the License.
+import gc
+import threading
+import weakref
 from unittest import TestCase
 
-from muffin.pan import derivative, parses, Alt, Any, Empty, Ex, Rep, Set, Term
+from muffin.charclass import CharClass
+from muffin.cups import Sep
+from muffin.pan import (compact, compile_grammar, context, count_parses,
+                        current, derivative, empty, forest, items, keywords,
+                        length, matches, nullable, parses, partition, rec,
+                        recognizer, run, scope, tie, trees, values, Alt, Alts,
+                        Any, Budget, Cat, Cats, Document, Empty, Ex, Keywords,
+                        Literal, Many, Null, OverBudget, ParseContext,
+                        ParseError, Parser, Red, Rep, Set, Stream, Term)
+from muffin.utensils import LRUCache, WeakCache
 
 
 fs = frozenset
@@ -77,3 +89,883 @@ class TestParse(TestCase):
         i = "aaa"
         e = fs([("a", "a", "a")])
         self.assertEqual(parses(l, i), e)
+
+    def test_repeat_long(self):
+        l = Sep(Ex("a"), Ex(","))
+        i = ",".join("a" * 3000)
+        e = fs([("a",) * 3000])
+        self.assertEqual(parses(l, i), e)
+
+    def test_many(self):
+        l = Many(Ex("a"))
+        i = "aa"
+        e = fs([("a", ("a", None))])
+        self.assertEqual(parses(l, i), e)
+
+    def test_many_items(self):
+        l = Red(Cat(Ex("a"), Many(Ex("a"))), items)
+        i = "aaa"
+        e = fs([("a", "a", "a")])
+        self.assertEqual(parses(l, i), e)
+
+
+class TestAlts(TestCase):
+
+    def test_parse(self):
+        l = Alts((Ex("a"), Ex("b"), Ex("c")))
+        self.assertEqual(parses(l, "b"), fs(["b"]))
+
+    def test_union(self):
+        l = Alts((Ex("a"), Red(Ex("a"), lambda x: x * 2), Ex("b")))
+        self.assertEqual(parses(l, "a"), fs(["a", "aa"]))
+
+    def test_derivative_drops_empty(self):
+        l = Alts((Cat(Ex("a"), Ex("x")), Ex("b"), Cat(Ex("a"), Ex("y"))))
+        d = derivative(l, "a")
+        self.assertTrue(isinstance(d, Alts))
+        self.assertEqual(len(d.ls), 2)
+
+    def test_nullable(self):
+        l = Alts((Ex("a"), Null, Ex("b")))
+        self.assertTrue(nullable(l))
+
+
+class TestCats(TestCase):
+
+    def test_nested(self):
+        l = Cats((Ex("a"), Ex("b"), Ex("c")))
+        e = fs([(("a", "b"), "c")])
+        self.assertEqual(parses(l, "abc"), e)
+
+    def test_same_as_cat(self):
+        a = Alt(Ex("a"), Null)
+        ls = a, Ex("b"), a, Ex("c")
+        l = Cats(ls)
+        chain = Cat(Cat(Cat(ls[0], ls[1]), ls[2]), ls[3])
+        for s in "bc", "abc", "bac", "abac":
+            self.assertEqual(parses(l, s), parses(chain, s))
+
+    def test_ambiguous(self):
+        a = Rep(Ex("a"))
+        l = Cats((a, a, a))
+        self.assertEqual(count_parses(l, "aa"), 6)
+
+    def test_long(self):
+        l = Cats(tuple(Ex(c) for c in "ab" * 100))
+        self.assertTrue(matches(l, "ab" * 100))
+        self.assertFalse(matches(l, "ab" * 99))
+
+
+class TestLiteral(TestCase):
+
+    def test_derivative(self):
+        l = Literal("abc", 0)
+        self.assertEqual(derivative(l, "a"), Literal("abc", 1))
+
+    def test_derivative_mismatch(self):
+        l = Literal("abc", 1)
+        self.assertEqual(derivative(l, "a"), Empty)
+
+    def test_parse(self):
+        l = Literal("abc", 0)
+        self.assertEqual(parses(l, "abc"), fs(["abc"]))
+
+    def test_expected(self):
+        l = Literal("abc", 0)
+        try:
+            parses(l, "ab")
+        except ParseError as pe:
+            self.assertEqual(pe.expected, fs(["c"]))
+        else:
+            self.fail("Parsed 'ab'")
+
+
+class TestKeywords(TestCase):
+
+    def test_parse(self):
+        l = keywords(["true", "false", "null"])
+        for s in "true", "false", "null":
+            self.assertEqual(parses(l, s), fs([s]))
+
+    def test_prefix(self):
+        l = keywords(["e", "e-"])
+        self.assertEqual(parses(l, "e"), fs(["e"]))
+        self.assertEqual(parses(l, "e-"), fs(["e-"]))
+
+    def test_derivative(self):
+        l = keywords(["ab", "ac"])
+        self.assertTrue(isinstance(derivative(l, "a"), Keywords))
+        self.assertEqual(derivative(l, "b"), Empty)
+
+    def test_partition(self):
+        l = keywords(["ab", "ac"])
+        classes = partition(l)
+        self.assertEqual(len(set(classes.values())), 3)
+
+
+class TestSet(TestCase):
+
+    def test_string(self):
+        l = Set("abc")
+        self.assertEqual(parses(l, "b"), fs(["b"]))
+        self.assertEqual(l, Set("cba"))
+
+    def test_negated(self):
+        l = Set(~CharClass.of(u"abc"))
+        self.assertEqual(parses(l, u"\u2603"), fs([u"\u2603"]))
+        self.assertFalse(matches(l, u"a"))
+        self.assertEqual(partition(l), None)
+
+    def test_container(self):
+        l = Set(fs([1, 2]))
+        self.assertEqual(parses(l, [2]), fs([2]))
+
+
+class TestItems(TestCase):
+
+    def test_one(self):
+        self.assertEqual(items(("a", None)), ("a",))
+
+    def test_several(self):
+        self.assertEqual(items(("a", ("b", ("c", None)))), ("a", "b", "c"))
+
+
+class TestBudget(TestCase):
+
+    def setUp(self):
+        # Every way of bracketing a sum, of which there are exponentially
+        # many.
+        self.l = Alt(Ex("N"), Cat(rec("S"), Cat(Ex("+"), rec("S"))))
+        tie(self.l, {"S": self.l})
+        self.s = "N" + "+N" * 30
+
+    def test_nodes(self):
+        with self.assertRaises(OverBudget) as cm:
+            parses(self.l, self.s, budget=Budget(nodes=1000))
+        self.assertEqual(cm.exception.resource, "nodes")
+        self.assertTrue(0 < cm.exception.offset < len(self.s))
+
+    def test_derivatives(self):
+        with self.assertRaises(OverBudget) as cm:
+            matches(self.l, self.s, budget=Budget(derivatives=500))
+        self.assertEqual(cm.exception.resource, "derivatives")
+        self.assertEqual(cm.exception.limit, 500)
+
+    def test_trees(self):
+        with self.assertRaises(OverBudget) as cm:
+            parses(self.l, "N" + "+N" * 8, budget=Budget(trees=100))
+        self.assertEqual(cm.exception.resource, "trees")
+
+    def test_seconds(self):
+        with self.assertRaises(OverBudget) as cm:
+            parses(self.l, "N" + "+N" * 100, budget=Budget(seconds=0.01))
+        self.assertEqual(cm.exception.resource, "seconds")
+
+    def test_within(self):
+        budget = Budget(nodes=10000, derivatives=10000, trees=1000,
+                        seconds=60)
+        self.assertEqual(len(parses(self.l, "N+N+N+N", budget=budget)), 5)
+        # Every parse spends a fresh copy.
+        self.assertEqual(len(parses(self.l, "N+N+N+N", budget=budget)), 5)
+
+    def test_parser(self):
+        p = Parser(self.l, budget=Budget(derivatives=500))
+        self.assertRaises(OverBudget, p.feed, self.s)
+
+
+class TestTie(TestCase):
+
+    def test_red(self):
+        l = Alt(Ex("a"),
+                Red(Cat(Ex("("), Cat(rec("l"), Ex(")"))), lambda x: x))
+        tie(l, {"l": l})
+        self.assertTrue(matches(l, "((a))"))
+
+
+class TestCompileGrammar(TestCase):
+
+    def test_untied(self):
+        self.assertRaises(ValueError, compile_grammar, Alt(Ex("a"), rec("l")))
+
+    def test_unproductive(self):
+        # The second alternative never stops recursing, so it parses nothing.
+        dead = Cat(Ex("b"), rec("dead"))
+        tie(dead, {"dead": dead})
+        self.assertEqual(compile_grammar(Alt(Ex("a"), Cat(Ex("c"), dead))),
+                         Ex("a"))
+
+    def test_rep(self):
+        l = Cat(Ex("a"), Rep(Empty))
+        self.assertFalse(empty(l))
+        self.assertEqual(parses(compile_grammar(l), "a"), fs([("a", None)]))
+
+    def test_constant(self):
+        l = compile_grammar(Red(Null, lambda x: 42))
+        self.assertEqual(l, Term(fs([42])))
+
+    def test_alts(self):
+        a, b, c = Literal("aa", 0), Literal("bb", 0), Literal("cc", 0)
+        self.assertEqual(compile_grammar(Alt(Alt(a, b), Alt(a, c))),
+                         Alts((a, b, a, c)))
+
+    def test_chars(self):
+        l = compile_grammar(Alt(Ex("a"), Alt(Set("bc"), Literal("dd", 0))))
+        self.assertEqual(l, Alt(Set("abc"), Literal("dd", 0)))
+
+    def test_overlapping_chars(self):
+        l = compile_grammar(Alt(Ex("a"), Alt(Set("ab"), Ex("c"))))
+        self.assertEqual(l, Alt(Ex("a"), Set("abc")))
+
+    def test_counts(self):
+        one = lambda _: 1
+        for l in (Alt(Ex("a"), Ex("a")),
+                  Alt(Ex("a"), Set("ab")),
+                  Cat(Alt(Red(Null, one), Red(Null, one)), Ex("a"))):
+            self.assertEqual(count_parses(compile_grammar(l), "a"),
+                             count_parses(l, "a"))
+
+    def test_cats(self):
+        l = Cat(Cat(Ex("a"), Rep(Ex("b"))), Ex("c"))
+        compiled = compile_grammar(l)
+        self.assertIsInstance(compiled, Cats)
+        self.assertEqual(parses(compiled, "abbc"), parses(l, "abbc"))
+
+    def test_parses(self):
+        from muffin.berry.json import value
+        l = compile_grammar(value)
+        s = '[{"a":[1,2,"x"]},{"b":[true,null]},-3.5e2]'
+        self.assertEqual(parses(l, s), parses(value, s))
+
+    def test_precomputed(self):
+        l = compile_grammar(Cat(Rep(Ex("a")), Ex("b")))
+        with scope(None, l) as s:
+            self.assertTrue(id(l) in s.properties["nullable"])
+            self.assertTrue(parses(l, "aab"))
+            s.forget()
+            self.assertTrue(id(l) in s.properties["nullable"])
+
+    def test_collected(self):
+        ref = weakref.ref(compile_grammar(Cat(Rep(Ex("a")), Ex("b"))))
+        gc.collect()
+        self.assertEqual(ref(), None)
+
+
+class TestParseContext(TestCase):
+
+    def test_entered(self):
+        outer = context()
+        with ParseContext() as c:
+            self.assertTrue(context() is c)
+            self.assertTrue(current() is c.scopes[-1])
+        self.assertTrue(context() is outer)
+
+    def test_interned_apart(self):
+        l = Ex("a")
+        with ParseContext():
+            self.assertTrue(Ex("a") is not l)
+
+    def test_threads(self):
+        contexts = []
+        results = []
+        l = Sep(Red(Rep(Set("ab")), lambda t: len(t or ())), Ex(","))
+
+        def parse(n):
+            contexts.append(context())
+            for i in range(20):
+                results.append(parses(l, ",".join(["ab" * n] * n)))
+
+        threads = [threading.Thread(target=parse, args=(n,))
+                   for n in range(1, 5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(set(map(id, contexts))), 4)
+        self.assertEqual(len(results), 80)
+        for ts in results:
+            t, = ts
+            self.assertEqual(t, (len(t) * 2,) * len(t))
+
+
+class TestScope(TestCase):
+
+    def test_discarded(self):
+        with scope() as s:
+            derivative(Ex("a"), "a")
+            self.assertEqual(len(s.cache), 1)
+        self.assertTrue(current() is not s)
+
+    def test_cat_is_not_alt(self):
+        with scope():
+            a = derivative(Alt(Ex("a"), Ex("b")), "a")
+            c = derivative(Cat(Ex("a"), Ex("b")), "a")
+        self.assertNotEqual(a, c)
+
+    def test_shared(self):
+        cache = LRUCache(100)
+        self.assertTrue(matches(Ex("a"), "a", cache))
+        self.assertTrue(matches(Ex("a"), "a", cache))
+        self.assertEqual(cache.hits, 1)
+
+    def test_shared_weak(self):
+        from muffin.berry.sexp import sexp
+        cache = WeakCache()
+
+        def parse(n):
+            for i in range(n):
+                parses(sexp, "(a%s)" % (" b" * (i % 7)), cache)
+            gc.collect()
+            return len(cache)
+
+        size = parse(20)
+        self.assertEqual(parse(100), size)
+
+
+class TestRun(TestCase):
+
+    def test_hook(self):
+        steps = []
+        l = Rep(Ex("a"))
+        matches(l, "aa", hook=lambda i, c, d: steps.append((i, c)))
+        self.assertEqual(steps, [(0, "a"), (1, "a")])
+
+
+class TestFixpoint(TestCase):
+
+    def test_nullable_cycle(self):
+        l = Alt(Cat(rec("l"), Ex("a")), Null)
+        tie(l, {"l": l})
+        self.assertTrue(nullable(l))
+
+    def test_nested(self):
+        l = Alt(Cat(Ex("("), Cat(rec("l"), Ex(")"))), Ex("x"))
+        tie(l, {"l": l})
+        i = "((x))"
+        e = fs([("(", (("(", ("x", ")")), ")"))])
+        self.assertEqual(parses(l, i), e)
+
+
+class TestCompact(TestCase):
+
+    def test_alt_empty(self):
+        l = Alt(Empty, Ex("a"))
+        self.assertEqual(compact(l), Ex("a"))
+
+    def test_cat_empty(self):
+        l = Cat(Ex("a"), Empty)
+        self.assertEqual(compact(l), Empty)
+
+    def test_cat_null_prefix(self):
+        l = Cat(Term(fs(["a"])), Ex("b"))
+        c = compact(l)
+        self.assertTrue(isinstance(c, Red))
+        self.assertEqual(c.l, Ex("b"))
+        self.assertEqual(c.f("b"), ("a", "b"))
+
+    def test_red_red(self):
+        l = Red(Red(Ex("a"), lambda x: x * 2), lambda x: x + "!")
+        c = compact(l)
+        self.assertEqual(c.l, Ex("a"))
+        self.assertEqual(c.f("a"), "aa!")
+
+    def test_red_term(self):
+        l = Red(Term(fs(["a"])), lambda x: x * 2)
+        self.assertEqual(compact(l), Term(fs(["aa"])))
+
+    def test_same_trees(self):
+        l = Rep(Alt(Ex("a"), Cat(Ex("b"), Ex("c"))))
+        i = "abca"
+        with scope():
+            expected = trees(run(l, i, every=0))
+        with scope():
+            self.assertEqual(trees(run(l, i, every=1)), expected)
+
+
+class TestParser(TestCase):
+
+    def test_chunks(self):
+        p = Parser(Sep(Ex("a"), Ex(",")))
+        p.feed("a,")
+        self.assertTrue(p.is_viable())
+        self.assertFalse(p.is_accepting())
+        p.feed("a")
+        self.assertTrue(p.is_accepting())
+        self.assertEqual(p.finish(), fs([("a", "a")]))
+
+    def test_not_viable(self):
+        p = Parser(Sep(Ex("a"), Ex(",")))
+        self.assertRaises(ParseError, p.feed, "a,,")
+        self.assertEqual(p.offset, 2)
+        self.assertTrue(p.is_viable())
+
+    def test_not_viable_uncompacted(self):
+        l = Alt(Cat(Ex("a"), Ex("b")), Cat(Ex("a"), Ex("c")))
+        for every in 0, 1:
+            p = Parser(l, every=every)
+            try:
+                p.feed("ax")
+            except ParseError as e:
+                self.assertEqual((e.offset, e.terminal), (1, "x"))
+                self.assertEqual(e.expected, fs("bc"))
+            else:
+                self.fail("Parsed")
+            self.assertEqual(p.offset, 1)
+            self.assertTrue(p.is_viable())
+
+    def test_bounded(self):
+        p = Parser(Sep(Ex("a"), Ex(",")))
+        p.feed("a")
+        for i in range(10):
+            p.feed(",a")
+        gc.collect()
+        size = len(p.scope.cache)
+        for i in range(50):
+            p.feed(",a")
+        gc.collect()
+        self.assertEqual(len(p.scope.cache), size)
+        self.assertEqual(p.offset, 121)
+
+
+class TestStream(TestCase):
+
+    def setUp(self):
+        self.l = Red(Cat(Ex("("), Cat(Rep(Set("ab")), Ex(")"))),
+                     lambda (x, (y, z)): "".join(y or ()))
+
+    def test_values(self):
+        s = Stream(self.l)
+        self.assertEqual(s.feed("(ab)(b"), [fs(["ab"])])
+        self.assertEqual(s.feed("a)()"), [fs(["ba"]), fs([""])])
+
+    def test_between(self):
+        s = Stream(self.l, " ")
+        self.assertEqual(s.feed(" (a)  (b) "), [fs(["a"]), fs(["b"])])
+
+    def test_longest(self):
+        l = Rep(Ex("a"))
+        s = Stream(Red(Cat(Ex("a"), l), lambda (x, xs): len(xs or ()) + 1),
+                   " ")
+        self.assertEqual(s.feed("aaa a"), [fs([3])])
+        self.assertEqual(s.feed("a"), [])
+        self.assertEqual(s.finish(), [fs([2])])
+
+    def test_unfinished(self):
+        s = Stream(self.l)
+        s.feed("(a")
+        self.assertRaises(ParseError, s.finish)
+
+    def test_error(self):
+        s = Stream(self.l)
+        s.feed("(a)(b")
+        self.assertRaises(ParseError, s.feed, "c")
+        self.assertEqual(s.feed(")"), [fs(["b"])])
+
+    def test_error_after_values(self):
+        s = Stream(self.l, " ")
+        try:
+            s.feed("(a) (b) x")
+        except ParseError as e:
+            self.assertEqual(e.offset, 8)
+            self.assertEqual(e.values, [fs(["a"]), fs(["b"])])
+        else:
+            self.fail("Parsed")
+        self.assertEqual(s.feed("(ab)"), [fs(["ab"])])
+
+    def test_pieces(self):
+        s = Stream(self.l)
+        pieces = list(s.pieces("(ab)(ba)", 3))
+        self.assertEqual(pieces, [[], [fs(["ab"])], [fs(["ba"])]])
+
+    def test_generator(self):
+        vs = list(values(self.l, ["(a", ")(b)", "()"]))
+        self.assertEqual(vs, [fs(["a"]), fs(["b"]), fs([""])])
+
+    def test_generator_error(self):
+        vs = values(self.l, ["(a", ")(b)x"])
+        self.assertEqual([next(vs), next(vs)], [fs(["a"]), fs(["b"])])
+        self.assertRaises(ParseError, next, vs)
+
+
+class TestDocument(TestCase):
+
+    def setUp(self):
+        self.offsets = []
+        l = Red(Rep(Set("ab")), lambda xs: "".join(xs or ()))
+        self.d = Document(l, "ab" * 10, spacing=4,
+                          hook=lambda i, c, l: self.offsets.append(i))
+
+    def test_trees(self):
+        self.assertEqual(self.d.trees(), fs(["ab" * 10]))
+
+    def test_edit(self):
+        self.d.trees()
+        self.d.edit(17, 18, "aa")
+        self.assertEqual(self.d.trees(), fs(["ab" * 8 + "aaaab"]))
+
+    def test_resume(self):
+        self.d.trees()
+        del self.offsets[:]
+        self.d.edit(13, 14, "a")
+        self.d.trees()
+        self.assertEqual(self.offsets, range(12, 20))
+
+    def test_edits_between(self):
+        self.d.trees()
+        self.d.edit(2, 2, "b")
+        self.d.edit(15, 21, "")
+        del self.offsets[:]
+        self.assertEqual(self.d.trees(), fs(["abbabababababab"]))
+        self.assertEqual(self.offsets, range(0, 15))
+
+    def test_limit(self):
+        self.d.limit = 3
+        self.d.trees()
+        self.assertEqual([i for i, l in self.d.checkpoints], [0, 8, 16])
+        self.assertEqual(self.d.spacing, 8)
+
+    def test_error(self):
+        self.d.edit(9, 10, "c")
+        self.assertRaises(ParseError, self.d.trees)
+        self.assertEqual([i for i, l in self.d.checkpoints], [0, 4, 8])
+        self.d.edit(9, 10, "b")
+        self.assertEqual(self.d.trees(), fs(["ab" * 10]))
+
+    def test_error_in_middle(self):
+        l = Alt(Cat(Ex("a"), Ex("b")), Cat(Ex("a"), Ex("c")))
+        try:
+            Document(l, "axb").trees()
+        except ParseError as e:
+            self.assertEqual((e.offset, e.terminal), (1, "x"))
+            self.assertEqual(e.expected, fs("bc"))
+        else:
+            self.fail("Parsed")
+
+
+class TestPartition(TestCase):
+
+    def test_classes(self):
+        classes = partition(Alt(Set("abc"), Ex("b")))
+        self.assertEqual(classes["a"], classes["c"])
+        self.assertNotEqual(classes["a"], classes["b"])
+        self.assertFalse("d" in classes)
+
+    def test_shared_empty(self):
+        l = Alt(Ex("x"), Ex("y"))
+        with scope(None, l) as s:
+            self.assertEqual(derivative(l, "a"), Empty)
+            size = len(s.cache)
+            self.assertEqual(derivative(l, "b"), Empty)
+            self.assertEqual(len(s.cache), size)
+
+    def test_shared_recognizing(self):
+        l = Cat(Set("ab"), Ex("c"))
+        with scope(None, l, trees=False) as s:
+            d = derivative(l, "a")
+            size = len(s.cache)
+            self.assertTrue(derivative(l, "b") is d)
+            self.assertEqual(len(s.cache), size)
+        self.assertTrue(matches(l, "bc"))
+
+    def test_terms(self):
+        l = Set("ab")
+        with scope(None, l):
+            self.assertEqual(derivative(l, "a"), Term(fs(["a"])))
+            self.assertEqual(derivative(l, "b"), Term(fs(["b"])))
+
+
+class TestInterning(TestCase):
+
+    def test_same(self):
+        self.assertTrue(Cat(Ex("a"), Ex("b")) is Cat(Ex("a"), Ex("b")))
+
+    def test_type(self):
+        self.assertFalse(Cat(Ex("a"), Ex("b")) is Alt(Ex("a"), Ex("b")))
+
+    def test_terms(self):
+        self.assertTrue(derivative(Ex("c"), "c") is Term(fs(["c"])))
+
+    def test_equal_trees(self):
+        for x, y in (1, True), (0, 0.0), ("a", u"a"), ((1,), (True,)):
+            self.assertFalse(Term(fs([x])) is Term(fs([y])))
+
+    def test_equal_reductions(self):
+        l = Cat(Red(Ex("a"), lambda _: 1), Red(Ex("b"), lambda _: True))
+        self.assertEqual(parses(l, "ab"), fs([(1, True)]))
+
+    def test_reductions(self):
+        l = Ex("a")
+        self.assertFalse(Red(l, lambda x: x) is Red(l, lambda x: x))
+        f = lambda x: x
+        self.assertTrue(Red(l, f) is Red(l, f))
+
+    def test_unhashable(self):
+        s = ["a", "b"]
+        self.assertTrue(Set(s) is Set(s))
+        self.assertFalse(Set(s) is Set(list(s)))
+
+    def test_collected(self):
+        ref = weakref.ref(Cat(Ex("x"), Ex("y")))
+        gc.collect()
+        self.assertEqual(ref(), None)
+
+    def test_parses_collected(self):
+        from muffin.berry.sexp import sexp
+
+        def sizes():
+            for i in range(50):
+                parses(sexp, "(a (b c) (d e))")
+            gc.collect()
+            return len(context().interned), len(gc.get_objects())
+
+        sizes()
+        interned, objects = sizes()
+        self.assertEqual(sizes()[0], interned)
+        # Leaking even a node per parse would be more than this.
+        self.assertTrue(sizes()[1] < objects + 50)
+
+
+class TestLength(TestCase):
+
+    def test_shared(self):
+        a = Ex("a")
+        self.assertEqual(length(Cat(a, a)), 2)
+
+    def test_cycle(self):
+        l = Alt(Ex("a"), rec("l"))
+        tie(l, {"l": l})
+        self.assertEqual(length(l), 3)
+
+    def test_deep(self):
+        # Neither hashing nor counting should walk down the graph
+        # recursively.
+        l = Ex("a")
+        for i in range(10000):
+            l = Cat(Ex("a"), l)
+        self.assertEqual(length(l), 10001)
+        self.assertEqual(len(set([l, l])), 1)
+
+
+class TestForest(TestCase):
+
+    def setUp(self):
+        # Every way of bracketing a sum.
+        self.l = Alt(Ex("N"), Cat(rec("l"), Cat(Ex("+"), rec("l"))))
+        tie(self.l, {"l": self.l})
+
+    def test_all(self):
+        s = "N+N+N+N"
+        self.assertEqual(fs(forest(self.l, s)), parses(self.l, s))
+
+    def test_take(self):
+        # There are 4862 trees here.
+        ts = forest(self.l, "N" + "+N" * 9).take(3)
+        self.assertEqual(len(ts), 3)
+        self.assertEqual(len(fs(ts)), 3)
+
+    def test_take_products(self):
+        # Each part has two trees, so there are 2 ** 40 products.
+        part = Alt(Red(Ex("a"), lambda _: 1), Red(Ex("a"), lambda _: 2))
+        ts = forest(Cats((part,) * 40), "a" * 40).take(3)
+        self.assertEqual(len(fs(ts)), 3)
+
+    def test_first(self):
+        t = forest(self.l, "N" + "+N" * 40).first()
+        self.assertEqual(t[1][0], "+")
+
+    def test_none(self):
+        p = Parser(self.l)
+        p.feed("N+")
+        self.assertRaises(ValueError, p.forest().first)
+
+    def test_parser(self):
+        p = Parser(self.l)
+        p.feed("N+N")
+        self.assertEqual(p.forest().take(2), [("N", ("+", "N"))])
+
+
+class TestCountParses(TestCase):
+
+    def setUp(self):
+        self.l = Alt(Ex("N"), Cat(rec("l"), Cat(Ex("+"), rec("l"))))
+        tie(self.l, {"l": self.l})
+
+    def test_small(self):
+        s = "N+N+N+N"
+        self.assertEqual(count_parses(self.l, s), len(parses(self.l, s)))
+
+    def test_catalan(self):
+        self.assertEqual(count_parses(self.l, "N" + "+N" * 30),
+                         3814986502092304)
+
+    def test_none(self):
+        self.assertEqual(count_parses(self.l, "N+"), 0)
+
+    def test_infinite(self):
+        l = Alt(Cat(rec("l"), Null), Null)
+        tie(l, {"l": l})
+        self.assertEqual(count_parses(l, ""), float("inf"))
+        self.assertEqual(count_parses(l, "x"), 0)
+
+    def test_overlapping(self):
+        self.assertEqual(count_parses(Alts((Set("ab"), Ex("a"))), "a"), 2)
+        self.assertEqual(count_parses(Alts((Ex("a"),) * 3), "a"), 3)
+
+    def test_same(self):
+        l = Alt(Ex("a"), Ex("a"))
+        self.assertEqual(count_parses(l, "a"), 2)
+        self.assertEqual(count_parses(Cat(l, Alt(Ex("b"), Set("b"))), "ab"),
+                         4)
+
+    def test_reduced(self):
+        l = Red(Alt(Ex("a"), Set("ab")), lambda _: 1)
+        self.assertEqual(count_parses(Cat(l, Ex("b")), "ab"), 2)
+
+    def test_repeated(self):
+        l = Rep(Alt(Ex("a"), Set("ab")))
+        self.assertEqual(count_parses(l, "aaa"), 8)
+
+
+class TestParseError(TestCase):
+
+    def setUp(self):
+        self.l = Sep(Alt(Ex("a"), Ex("b")), Ex(","))
+
+    def test_first(self):
+        # The parse stops at the first bad terminal, not the last one.
+        try:
+            parses(self.l, "a,x,y")
+        except ParseError as pe:
+            self.assertEqual(pe.offset, 2)
+            self.assertEqual(pe.terminal, "x")
+            self.assertEqual(pe.expected, fs(["a", "b"]))
+        else:
+            self.fail("Parsed")
+
+    def test_end(self):
+        try:
+            parses(self.l, "a,")
+        except ParseError as pe:
+            self.assertEqual(pe.offset, 2)
+            self.assertEqual(pe.terminal, None)
+        else:
+            self.fail("Parsed")
+
+    def test_stops(self):
+        seen = []
+        hook = lambda *args: seen.append(args)
+        self.assertFalse(matches(self.l, "ax,,,,", hook=hook))
+        self.assertEqual(len(seen), 1)
+
+    def test_stops_later(self):
+        seen = []
+        hook = lambda i, c, l: seen.append(i)
+        self.assertFalse(matches(self.l, "a,b,x,a", hook=hook))
+        self.assertEqual(seen, [0, 1, 2, 3])
+
+    def test_any(self):
+        try:
+            parses(Cat(Ex("a"), Any), "")
+        except ParseError as pe:
+            self.assertEqual(pe.expected, fs(["a"]))
+        else:
+            self.fail("Parsed")
+        try:
+            parses(Cat(Ex("a"), Any), "a")
+        except ParseError as pe:
+            self.assertEqual(pe.expected, fs([Any]))
+        else:
+            self.fail("Parsed")
+
+    def assertRejects(self, l, s, offset, terminal, expected):
+        try:
+            parses(l, s)
+        except ParseError as pe:
+            self.assertEqual(pe.offset, offset)
+            self.assertEqual(pe.terminal, terminal)
+            self.assertEqual(pe.expected, fs(expected))
+        else:
+            self.fail("Parsed")
+
+    def test_red(self):
+        # The derivative of the reduction is left lazy, and only turns out
+        # empty once it is looked into.
+        l = Alt(Null, Alt(Red(Ex("a"), lambda x: x), Set("ab")))
+        self.assertRejects(l, "c", 0, "c", "ab")
+
+    def test_rep(self):
+        l = Rep(Alt(Ex("a"), Red(Ex("b"), lambda x: x)))
+        self.assertRejects(l, "caaaca", 0, "c", "ab")
+        self.assertRejects(l, "abca", 2, "c", "ab")
+
+    def test_iterator(self):
+        self.assertRejects(self.l, iter("a,"), 2, None, "ab")
+
+
+class TestRecognizer(TestCase):
+
+    def test_erased(self):
+        l = Red(Cat(Ex("a"), Term(fs(["b"]))), lambda x: x)
+        self.assertEqual(recognizer(l), Cat(Ex("a"), Null))
+
+    def test_cached(self):
+        l = Red(Ex("a"), lambda x: x)
+        self.assertTrue(recognizer(l) is recognizer(l))
+
+    def test_unchanged(self):
+        l = Cat(Ex("a"), Ex("b"))
+        self.assertTrue(recognizer(l) is l)
+
+    def test_recursive(self):
+        l = Alt(Null, Cat(Red(Ex("("), len), Cat(rec("l"), Ex(")"))))
+        tie(l, {"l": l})
+        self.assertTrue(matches(l, "((()))"))
+        self.assertFalse(matches(l, "(()"))
+
+    def test_no_trees(self):
+        l = Rep(Red(Set("ab"), lambda x: x))
+        with scope(None, l, trees=False):
+            d = derivative(l, "a")
+        self.assertEqual(d, Cat(Null, l))
+
+    def test_shared(self):
+        cache = LRUCache(100)
+        l = Rep(Ex("a"))
+        self.assertTrue(matches(l, "aa", cache))
+        self.assertEqual(parses(l, "aa", cache), fs([("a", "a")]))
+
+
+class TestDefer(TestCase):
+
+    def setUp(self):
+        self.calls = []
+
+        def f(t):
+            self.calls.append(t)
+            return t
+
+        def g(t):
+            self.calls.append(t)
+            return t
+
+        self.l = Alt(Cat(Red(Ex("a"), f), Ex("x")),
+                     Cat(Red(Ex("a"), g), Ex("y")))
+
+    def test_eager(self):
+        self.assertEqual(parses(self.l, "ay"), fs([("a", "y")]))
+        self.assertEqual(len(self.calls), 2)
+
+    def test_deferred(self):
+        self.assertEqual(parses(self.l, "ay", defer=True), fs([("a", "y")]))
+        self.assertEqual(self.calls, ["a"])
+
+    def test_nested(self):
+        l = Sep(Red(Rep(Set("ab")), lambda t: len(t or ())), Ex(","))
+        s = "ab,,bab"
+        self.assertEqual(parses(l, s, defer=True), parses(l, s))
+
+    def test_parser(self):
+        p = Parser(Sep(Red(Ex("a"), str.upper), Ex(",")), defer=True)
+        p.feed("a,a")
+        self.assertEqual(p.finish(), fs([("A", "A")]))
+        self.assertEqual(p.forest().take(1), [("A", "A")])
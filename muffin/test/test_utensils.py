@@ -13,7 +13,23 @@
 # under the License.
 from unittest import TestCase
 
-from muffin.utensils import inub
+from muffin.utensils import LRUCache, WeakCache, compose, inub, solve
+
+
+class TestCompose(TestCase):
+
+    def test_order(self):
+        f = compose(lambda x: x + 1, lambda x: x * 2)
+        self.assertEqual(f(1), 4)
+
+    def test_flat(self):
+        f = lambda x: x + 1
+        g = f
+        for i in range(5000):
+            g = compose(g, f)
+        self.assertEqual(len(g.functions), 5001)
+        self.assertEqual(g(0), 5001)
+
 
 class TestNub(TestCase):
 
@@ -33,3 +49,85 @@ class TestNub(TestCase):
         o = list(inub(i))
         e = [1, 2, 3, 4]
         self.assertEqual(e, o)
+
+
+class TestLRUCache(TestCase):
+
+    def test_evict(self):
+        c = LRUCache(2)
+        c[1] = "a"
+        c[2] = "b"
+        c[3] = "c"
+        self.assertEqual(c.get(1), None)
+        self.assertEqual(c.evictions, 1)
+        self.assertEqual(len(c), 2)
+
+    def test_recent(self):
+        c = LRUCache(2)
+        c[1] = "a"
+        c[2] = "b"
+        c.get(1)
+        c[3] = "c"
+        self.assertEqual(c.get(1), "a")
+        self.assertEqual(c.get(2), None)
+
+    def test_stats(self):
+        c = LRUCache(2)
+        c[1] = "a"
+        c.get(1)
+        c.get(2)
+        self.assertEqual(c.hits, 1)
+        self.assertEqual(c.misses, 1)
+
+
+class Key(object):
+    pass
+
+
+class TestWeakCache(TestCase):
+
+    def test_hit(self):
+        c = WeakCache()
+        k = Key()
+        c[k, "x"] = 42
+        self.assertEqual(c.get((k, "x")), 42)
+        self.assertEqual(c.hits, 1)
+
+    def test_collected(self):
+        c = WeakCache()
+        k = Key()
+        c[k, "x"] = 42
+        c[k, "y"] = 7
+        del k
+        self.assertEqual(len(c), 0)
+        self.assertEqual(c.evictions, 2)
+
+    def test_weak_values(self):
+        c = WeakCache()
+        k = Key()
+        v = Key()
+        c[k, "x"] = v
+        self.assertTrue(c.get((k, "x")) is v)
+        del v
+        self.assertEqual(len(c), 0)
+
+
+class TestSolve(TestCase):
+
+    graph = {
+        "a": ["b"],
+        "b": ["a", "c"],
+        "c": [],
+    }
+
+    def reachable(self, x, get):
+        return frozenset([x]).union(*[get(y) for y in self.graph[x]])
+
+    def test_cycle(self):
+        v = solve("a", frozenset(), self.reachable, {})
+        self.assertEqual(v, frozenset("abc"))
+
+    def test_values(self):
+        values = {}
+        solve("a", frozenset(), self.reachable, values)
+        self.assertEqual(values[id("c")], ("c", frozenset("c")))
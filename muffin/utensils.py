@@ -11,15 +11,61 @@
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and limitations
 # under the License.
+from collections import OrderedDict, defaultdict
+import weakref
+
+
 def const(x):
     return x
 
 
+class Composition(object):
+    """
+    A pipeline of functions, each applied to the result of the one before.
+
+    Composing takes constant time: a composition only holds the two functions
+    it was made from. It is flattened into a tuple of functions, without
+    recursing, the first time it is needed, so that composing compositions
+    over and over neither copies nor nests them.
+    """
+
+    def __init__(self, first, then):
+        self.first = first
+        self.then = then
+        self._functions = None
+
+    @property
+    def functions(self):
+        if self._functions is None:
+            functions = []
+            stack = [self.then, self.first]
+            while stack:
+                f = stack.pop()
+                if not isinstance(f, Composition):
+                    functions.append(f)
+                elif f._functions is not None:
+                    functions.extend(f._functions)
+                else:
+                    stack.append(f.then)
+                    stack.append(f.first)
+            self._functions = tuple(functions)
+        return self._functions
+
+    @property
+    def __name__(self):
+        return "compose(%s)" % ", ".join(f.__name__ for f in self.functions)
+
+    def __repr__(self):
+        return "<%s>" % self.__name__
+
+    def __call__(self, x):
+        for f in self.functions:
+            x = f(x)
+        return x
+
+
 def compose(f, g):
-    def h(x):
-        return g(f(x))
-    h.__name__ = "compose(%s, %s)" % (f.__name__, g.__name__)
-    return h
+    return Composition(f, g)
 
 
 def curry_first(x):
@@ -34,39 +80,198 @@ def curry_second(x):
     return second
 
 
-def key(args, kwargs):
-    return args, frozenset(kwargs.iteritems())
+class Cache(object):
+    """
+    An unbounded cache which keeps count of its hits and misses.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._d = {}
+
+    def __len__(self):
+        return len(self._d)
+
+    def __setitem__(self, k, v):
+        self._d[k] = v
+
+    def get(self, k, default=None):
+        if k in self._d:
+            self.hits += 1
+            return self._d[k]
+        self.misses += 1
+        return default
+
+    def clear(self):
+        self._d.clear()
 
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "size": len(self),
+        }
 
-def kleene(bottom):
+
+class LRUCache(Cache):
     """
-    Kleene's fixed point.
-
-    Ascend from a bottom value to a recursively-defined value. Usage is
-    similar to a general fixed-point combinator, like U, Y, or Z, but with
-    memoization and an explicit bottom value. This decorator can thus be used
-    to deal with ill-founded recursion, as long as the values involved are
-    sufficiently pure; if this decorator sees a value twice under the same
-    circumstances, it will "bottom out" and ensure that the computation
-    terminates eventually.
+    A cache which holds at most a certain number of entries, evicting the
+    least recently used entry when it fills up.
     """
 
-    def first(f):
-        cache = {}
+    def __init__(self, limit):
+        Cache.__init__(self)
+        self.limit = limit
+        self._d = OrderedDict()
 
-        def second(x):
-            def z(*args, **kwargs):
-                k = key(args, kwargs)
-                if k in cache:
-                    v = cache[k]
-                else:
-                    cache[k] = bottom
-                    v = x(x)(*args, **kwargs)
-                    cache[k] = v
-                return v
-            return f(z)
-        return second(second)
-    return first
+    def __setitem__(self, k, v):
+        self._d.pop(k, None)
+        self._d[k] = v
+        while len(self._d) > self.limit:
+            self._d.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, k, default=None):
+        if k in self._d:
+            self.hits += 1
+            v = self._d.pop(k)
+            self._d[k] = v
+            return v
+        self.misses += 1
+        return default
+
+
+class WeakCache(Cache):
+    """
+    A cache keyed on tuples whose first member is only weakly referenced.
+
+    The first member is compared by identity. Once it is collected, every
+    entry under it is evicted. Values which refer back to their own key will
+    keep that key alive, as with any weakly-keyed mapping.
+
+    Values are weakly referenced too, wherever they can be, and their
+    entries are evicted once they are collected. If weak_values is unset,
+    they are kept instead, and a value can keep the keys of other entries
+    alive, and so on down a chain of entries; a cache of derivatives kept
+    like that grows with every parse.
+    """
+
+    def __init__(self, weak_values=True):
+        Cache.__init__(self)
+        self.weak_values = weak_values
+        self._refs = {}
+
+    def __len__(self):
+        return sum(len(entries) for entries in self._d.itervalues())
+
+    def __setitem__(self, k, v):
+        head, rest = k[0], k[1:]
+        i = id(head)
+        if i not in self._d:
+            self._refs[i] = weakref.ref(head, lambda _: self._forget(i))
+            self._d[i] = {}
+        entry = None
+        if self.weak_values:
+            try:
+                entry = weakref.ref(v, lambda ref: self._drop(i, rest, ref))
+            except TypeError:
+                pass
+        if entry is None:
+            entry = lambda: v
+        self._d[i][rest] = entry
+
+    def get(self, k, default=None):
+        entries = self._d.get(id(k[0]))
+        if entries is not None and k[1:] in entries:
+            self.hits += 1
+            return entries[k[1:]]()
+        self.misses += 1
+        return default
+
+    def clear(self):
+        self._d.clear()
+        self._refs.clear()
+
+    def _forget(self, i):
+        self.evictions += len(self._d.pop(i, ()))
+        self._refs.pop(i, None)
+
+    def _drop(self, i, rest, ref):
+        entries = self._d.get(i)
+        if entries is not None and entries.get(rest) is ref:
+            del entries[rest]
+            self.evictions += 1
+
+
+def solve(x, bottom, rule, values, known=None):
+    """
+    Compute a recursively-defined property of a node in a graph, by
+    iterating to a fixed point.
+
+    The rule computes a node's property, given a function for looking up the
+    current properties of its children. Children start at the bottom value
+    and are only visited once the rule looks them up, so rules may
+    short-circuit. Whenever a node's property changes, the nodes which looked
+    it up are recomputed, until nothing changes. The rule must be monotonic,
+    or this will not terminate.
+
+    Nodes are told apart by identity. The finished properties of visited
+    nodes are stored in values, keyed by id() alongside the node itself, so
+    that later calls can stop at them. If given, known() may reject nodes
+    whose properties can only be guessed for now; the guesses are used, but
+    neither they nor anything which depends on them are stored.
+    """
+
+    if id(x) in values:
+        return values[id(x)][1]
+
+    nodes = {id(x): x}
+    current = {id(x): bottom}
+    parents = defaultdict(set)
+    guessed = []
+    work = [id(x)]
+    queued = set(work)
+
+    while work:
+        i = work.pop()
+        queued.discard(i)
+
+        def get(child):
+            j = id(child)
+            if j in values:
+                return values[j][1]
+            parents[j].add(i)
+            if j not in current:
+                nodes[j] = child
+                current[j] = bottom
+                if known is not None and not known(child):
+                    guessed.append(j)
+                queued.add(j)
+                work.append(j)
+            return current[j]
+
+        v = rule(nodes[i], get)
+        if v != current[i]:
+            current[i] = v
+            for parent in parents[i]:
+                if parent not in queued:
+                    queued.add(parent)
+                    work.append(parent)
+
+    rv = current[id(x)]
+
+    while guessed:
+        i = guessed.pop()
+        if i in current:
+            del current[i]
+            guessed.extend(parents[i])
+
+    for i, v in current.iteritems():
+        values[i] = nodes[i], v
+    return rv
 
 
 def once(f):